@@ -7,16 +7,30 @@ client for Chino.io API
 :license: Apache 2.0, see LICENSE for more details.
 """
 import hashlib
+import heapq
+import io
 import json
 import os
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Full
 
 import requests
 import sys
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth, AuthBase
 
 from exceptions import MethodNotSupported, CallError, CallFail, ClientError
-from objects import Repository, ListResult, User, Group, Schema, Document, Blob, BlobDetail, UserSchema, \
-    Collection, Permission, IDs, Application
+from objects import Repository, ListResult, User, Group, Schema, Document, Blob, BlobDetail, BlobDownload, \
+    UserSchema, Collection, Permission, IDs, Application, dict_list_result
+from validators import SchemaCache
+from cache import BlobIndex, BlobCache, DocumentCache, CountCache, UsernameIndex, _replace
+from permissions import PermissionIndex, CALLER, subject_key, compile_permissions, desired_keys, \
+    diff_permissions
+from query import Query, Plan, PlanCache, query_key, check_query, split_range, range_filters, \
+    sort_key, field_value
 
 import logging
 import logging.config
@@ -27,6 +41,18 @@ __author__ = 'Stefano Tranquillini <stefano@chino.io>'
 logger = logging.getLogger('chino.api')
 
 
+def _dumps(data):
+    """
+    Encodes the body of a call: objects are converted with ``to_dict()``, the json is compact.
+    Bodies already encoded (str) are sent as they are.
+    """
+    if isinstance(data, str):
+        return data
+    if hasattr(data, 'to_dict'):
+        data = data.to_dict()
+    return json.dumps(data, separators=(',', ':'))
+
+
 class ChinoAPIBase(object):  # PRAGMA: NO COVER
     """
         Base class, contains the utils methods to call the APIs
@@ -34,6 +60,23 @@ class ChinoAPIBase(object):  # PRAGMA: NO COVER
     _url = None
     auth = None
     timeout = 30
+    # shared by the client between the classes, see ChinoAPIClient
+    schema_cache = None
+    validate = False
+    # if True list, detail and search return the decoded json instead of objects
+    as_dict = False
+    # connections kept open by the session, requests' default
+    _pool_size = 10
+    # index of the blobs uploaded, see ChinoAPIClient
+    blob_index = None
+    blob_cache = None
+    # documents read, see ChinoAPIClient
+    document_cache = None
+    count_cache = None
+    username_index = None
+    permission_index = None
+    # compiled searches, see chino.query
+    plan_cache = None
 
     def __init__(self, auth, url, timeout, session=True):
         """
@@ -52,7 +95,7 @@ class ChinoAPIBase(object):  # PRAGMA: NO COVER
             self.req = requests
 
     # UTILS
-    def apicall(self, method, url, params=None, data=None, form=None, raw=False):
+    def apicall(self, method, url, params=None, data=None, form=None, raw=False, stream=False, headers=None):
         method = method.upper()
         url = self._url + url
         if method == 'CHUNK':
@@ -61,7 +104,7 @@ class ChinoAPIBase(object):  # PRAGMA: NO COVER
         else:
             logger.debug("calling %s %s p(%s) d(%s) " % (method, url, params, str(data)))
             if method == 'GET':
-                res = self._apicall_get(url, params)
+                res = self._apicall_get(url, params, stream, headers)
             elif method == 'POST':
                 res = self._apicall_post(url, data, params, form)
             elif method == 'PUT':
@@ -84,39 +127,29 @@ class ChinoAPIBase(object):  # PRAGMA: NO COVER
         return data
 
     def _apicall_chunk(self, url, data, offset, length):
-        r = self.req.put(url, data=data, auth=self._get_auth(),
-                         headers={'Content-Type': 'application/octet-stream', 'offset': offset, 'length': length})
+        r = self.req.put(url, data=data, auth=self._get_auth(), timeout=self.timeout,
+                         headers={'Content-Type': 'application/octet-stream', 'offset': str(offset),
+                                  'length': str(length)})
         return r
 
     def _apicall_put(self, url, data):
-        if hasattr(data, 'to_dict()'):
-            d = data.to_dict()
-        else:
-            d = data
-        r = self.req.put(url, auth=self._get_auth(), data=json.dumps(d), timeout=self.timeout)
+        r = self.req.put(url, auth=self._get_auth(), data=_dumps(data), timeout=self.timeout)
         return r
 
     def _apicall_patch(self, url, data):
-        if hasattr(data, 'to_dict()'):
-            d = data.to_dict()
-        else:
-            d = data
-        r = self.req.patch(url, auth=self._get_auth(), data=json.dumps(d), timeout=self.timeout)
+        r = self.req.patch(url, auth=self._get_auth(), data=_dumps(data), timeout=self.timeout)
         return r
 
     def _apicall_post(self, url, data, params, form=None):
         if data is None and form is not None:
             r = self.req.post(url, auth=self._get_auth(), params=params, data=form, timeout=self.timeout)
         else:
-            if hasattr(data, 'to_dict()'):
-                d = data.to_dict()
-            else:
-                d = data
-            r = self.req.post(url, auth=self._get_auth(), params=params, data=json.dumps(d), timeout=self.timeout)
+            r = self.req.post(url, auth=self._get_auth(), params=params, data=_dumps(data), timeout=self.timeout)
         return r
 
-    def _apicall_get(self, url, params):
-        r = self.req.get(url, auth=self._get_auth(), params=params, timeout=self.timeout)
+    def _apicall_get(self, url, params, stream=False, headers=None):
+        r = self.req.get(url, auth=self._get_auth(), params=params, timeout=self.timeout, stream=stream,
+                         headers=headers)
         return r
 
     def _apicall_delete(self, url, params):
@@ -126,6 +159,48 @@ class ChinoAPIBase(object):  # PRAGMA: NO COVER
     def _get_auth(self):
         return self.auth.get_auth()
 
+    def _ensure_pool_size(self, size):
+        """
+        Makes the session keep up to ``size`` connections open to the API, so concurrent calls reuse them.
+        """
+        if size > self._pool_size and isinstance(self.req, requests.Session):
+            self.req.mount(self._url, HTTPAdapter(pool_maxsize=size))
+            self._pool_size = size
+
+    def _list_result(self, class_obj, result, as_dict=None):
+        if as_dict is None:
+            as_dict = self.as_dict
+        if as_dict:
+            return dict_list_result(class_obj, result)
+        return ListResult(class_obj, result)
+
+    def _object(self, class_obj, data, as_dict=None):
+        if as_dict is None:
+            as_dict = self.as_dict
+        if as_dict:
+            return data
+        return class_obj(**data)
+
+    def _validate_content(self, schema_id, content):
+        if self.validate and self.schema_cache is not None:
+            url = "schemas/%s" % schema_id
+            self.schema_cache.validate(schema_id, content,
+                                       lambda: self.apicall('GET', url)['schema']['structure']['fields'])
+
+    def _validate_attributes(self, user_schema_id, attributes):
+        if self.validate and self.schema_cache is not None:
+            url = "user_schemas/%s" % user_schema_id
+            self.schema_cache.validate(user_schema_id, attributes,
+                                       lambda: self.apicall('GET', url)['user_schema']['structure']['fields'])
+
+    def _invalidate_schema(self, schema_id):
+        if self.schema_cache is not None:
+            self.schema_cache.invalidate(schema_id)
+        if self.plan_cache is not None:
+            self.plan_cache.invalidate(schema_id)
+        if self.count_cache is not None:
+            self.count_cache.invalidate(schema_id)
+
     @staticmethod
     def valid_call(r):
         # logger.debug("%s Response %s ", r.request.url, r.json())
@@ -135,7 +210,8 @@ class ChinoAPIBase(object):  # PRAGMA: NO COVER
             try:
                 status = r.json()['result']
             except:
-                raise CallError(code=500, message="Something went wrong with the server")
+                # keep the HTTP status, callers use it to tell e.g. a 405 from a real server error
+                raise CallError(code=r.status_code, message="Something went wrong with the server")
             if status == 'error':
                 raise CallError(code=r.status_code, message=r.json()['message'])
             elif status == 'fail':
@@ -144,6 +220,23 @@ class ChinoAPIBase(object):  # PRAGMA: NO COVER
                 raise CallError(code=r.status_code, message=r.json())
 
 
+def _diff_content(old, new):
+    """
+    Compares two contents and returns the dict of new/changed fields and the list of removed ones.
+    ``True`` and ``1`` are considered different, as they are for the schema.
+    """
+    changed = dict()
+    for key, value in new.iteritems():
+        if key not in old:
+            changed[key] = value
+            continue
+        prev = old[key]
+        if prev != value or isinstance(prev, bool) != isinstance(value, bool):
+            changed[key] = value
+    removed = [key for key in old if key not in new]
+    return changed, removed
+
+
 class ChinoAPIUsers(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPIUsers, self).__init__(auth, url, timeout, session)
@@ -211,9 +304,9 @@ class ChinoAPIUsers(ChinoAPIBase):
             # propagate exception
             raise ex
 
-    def current(self):
+    def current(self, as_dict=None):
         url = "users/me"
-        return User(**self.apicall('GET', url)['user'])
+        return self._object(User, self.apicall('GET', url)['user'], as_dict)
 
     def logout(self):
         url = "auth/revoke_token/"
@@ -230,29 +323,39 @@ class ChinoAPIUsers(ChinoAPIBase):
             # propagate exception
             raise ex
 
-    def list(self, user_schema_id, **pars):
+    def list(self, user_schema_id, as_dict=None, **pars):
         url = "user_schemas/%s/users" % user_schema_id
-        return ListResult(User, self.apicall('GET', url, params=pars))
+        return self._list_result(User, self.apicall('GET', url, params=pars), as_dict)
 
-    def detail(self, user_id):
+    def detail(self, user_id, as_dict=None):
         url = "users/%s" % user_id
-        return User(**self.apicall('GET', url)['user'])
+        return self._object(User, self.apicall('GET', url)['user'], as_dict)
 
     def create(self, user_schema_id, username, password, attributes=None):
+        self._validate_attributes(user_schema_id, attributes)
         data = dict(username=username, password=password, attributes=attributes)
         url = "user_schemas/%s/users" % user_schema_id
-        return User(**self.apicall('POST', url, data=data)['user'])
+        res = User(**self.apicall('POST', url, data=data)['user'])
+        if self.username_index is not None:
+            self.username_index.add(username, user_schema_id)
+        return res
 
     def update(self, user_id, **kwargs):
         url = "users/%s" % user_id
         u_updated = self.apicall('PUT', url, data=kwargs)['user']
+        self._username_taken(kwargs, u_updated)
         return User(**u_updated)
 
     def partial_update(self, user_id, **kwargs):
         url = "users/%s" % user_id
         u_updated = self.apicall('PATCH', url, data=kwargs)['user']
+        self._username_taken(kwargs, u_updated)
         return User(**u_updated)
 
+    def _username_taken(self, sent, user):
+        if self.username_index is not None and sent.get('username'):
+            self.username_index.add(sent['username'], user.get('schema_id'))
+
     def delete(self, user_id, force=False):
         url = "users/%s" % user_id
         if force:
@@ -266,13 +369,13 @@ class ChinoAPIGroups(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPIGroups, self).__init__(auth, url, timeout, session)
 
-    def list(self, **pars):
+    def list(self, as_dict=None, **pars):
         url = "groups"
-        return ListResult(Group, self.apicall('GET', url, params=pars))
+        return self._list_result(Group, self.apicall('GET', url, params=pars), as_dict)
 
-    def detail(self, group_id):
+    def detail(self, group_id, as_dict=None):
         url = "groups/%s" % group_id
-        return Group(**self.apicall('GET', url)['group'])
+        return self._object(Group, self.apicall('GET', url)['group'], as_dict)
 
     def create(self, groupname, attributes=None):
         data = dict(group_name=groupname, attributes=attributes)
@@ -311,7 +414,9 @@ class ChinoAPIPermissions(ChinoAPIBase):
             data['manage'] = manage
         if authorize:
             data['authorize'] = authorize
-        return self.apicall('POST', url, data=data)
+        res = self.apicall('POST', url, data=data)
+        self._changed(subject_type, subject_id)
+        return res
 
     def resource(self, action, resource_type, resource_id, subject_type, subject_id,
                  manage=None, authorize=None):
@@ -321,7 +426,9 @@ class ChinoAPIPermissions(ChinoAPIBase):
             data['manage'] = manage
         if authorize:
             data['authorize'] = authorize
-        return self.apicall('POST', url, data=data)
+        res = self.apicall('POST', url, data=data)
+        self._changed(subject_type, subject_id)
+        return res
 
     def resource_children(self, action, resource_type, resource_id, resource_child_type, subject_type, subject_id,
                           manage=None, authorize=None, created_document=None):
@@ -334,7 +441,15 @@ class ChinoAPIPermissions(ChinoAPIBase):
             data['authorize'] = authorize
         if created_document:
             data['created_document'] = created_document
-        return self.apicall('POST', url, data=data)
+        res = self.apicall('POST', url, data=data)
+        self._changed(subject_type, subject_id)
+        return res
+
+    def _changed(self, subject_type, subject_id):
+        if self.permission_index is not None:
+            self.permission_index.invalidate(subject_key(subject_type, subject_id))
+            # the subject may be the caller
+            self.permission_index.invalidate(CALLER)
 
     def read_perms(self):
         url = "perms"
@@ -343,7 +458,10 @@ class ChinoAPIPermissions(ChinoAPIBase):
 
     def read_perms_document(self, document_id):
         url = "perms/documents/%s" % document_id
-        return [Permission(**p) for p in self.apicall('GET', url)['permissions']]
+        res = [Permission(**p) for p in self.apicall('GET', url)['permissions']]
+        if self.permission_index is not None:
+            self.permission_index.add(CALLER, res)
+        return res
 
     def read_perms_user(self, user_id):
         url = "perms/users/%s" % user_id
@@ -353,12 +471,99 @@ class ChinoAPIPermissions(ChinoAPIBase):
         url = "perms/groups/%s" % group_id
         return [Permission(**p) for p in self.apicall('GET', url)['permissions']]
 
+    def can(self, action, resource_type, resource_id=None, parent_id=None, subject_type=None, subject_id=None,
+            authorize=False, groups=()):
+        """
+        Checks a permission with the permission index of the client, the permissions of the subject are read
+        (``read_perms_user``, ``read_perms_group`` or ``read_perms`` for the caller) only if they are not in the index.
+
+        :param action: (str) ``R``, ``read``, ...
+        :param resource_type: (str) e.g. ``documents``
+        :param resource_id: (id) of the resource
+        :param parent_id: (id) of the parent of the resource, e.g. the schema of a document
+        :param subject_type: (str) ``users`` or ``groups``, None for the caller
+        :param subject_id: (id) of the user or group
+        :param authorize: (bool) if True checks if the subject can grant the action to others
+        :param groups: list of (id) of the groups of the user, their permissions count too
+        :return: (bool)
+        """
+        if self.permission_index is None:
+            # used without ChinoAPIClient, the index is private to this instance
+            self.permission_index = PermissionIndex()
+        subject = subject_key(subject_type, subject_id)
+        if subject == CALLER:
+            loader = self.read_perms
+        elif subject[0] == 'groups':
+            loader = lambda: self.read_perms_group(subject_id)
+        else:
+            loader = lambda: self.read_perms_user(subject_id)
+        return self.permission_index.can(subject, action, resource_type, resource_id, parent_id, authorize, loader,
+                                         groups, self.read_perms_group)
+
+    def reconcile(self, desired, prune=False, parallelism=4, dry_run=False):
+        """
+        Grants (and with ``prune`` revokes) what is needed to give the subjects the desired permissions.
+        The permissions of the subjects are read, then only the calls that change something are done, ``parallelism``
+        at the same time. If nothing changed, it costs only the reads.
+
+        Example::
+
+            chino.permissions.reconcile({
+                ('users', user_id): [
+                    dict(resource_type='repositories', manage=['R', 'L']),
+                    dict(resource_type='schemas', resource_id=schema_id, resource_child_type='documents',
+                         manage=['C', 'R'], authorize=['R']),
+                ],
+                ('groups', group_id): [dict(resource_type='documents', resource_id=document_id, manage=['R'])],
+            })
+
+        :param desired: dict (subject_type, subject_id) -> list of grants, see ``chino.permissions.desired_keys``
+        :param prune: (bool) if True the permissions of the subjects that are not desired are revoked
+        :param parallelism: (int) calls done at the same time
+        :param dry_run: (bool) if True the changes are computed but not done
+        :return: list of ``PermissionChange`` done (or to do with ``dry_run``)
+        """
+        subjects = [subject_key(subject_type, subject_id) for subject_type, subject_id in desired]
+        grants = [desired_keys(desired[key]) for key in desired]
+
+        def read(subject):
+            if subject[0] == 'groups':
+                return compile_permissions(self.read_perms_group(subject[1]))
+            return compile_permissions(self.read_perms_user(subject[1]))
+
+        def apply_change(change):
+            if change.resource_child_type:
+                self.resource_children(change.action, change.resource_type, change.resource_id,
+                                       change.resource_child_type, change.subject_type, change.subject_id,
+                                       manage=change.manage, authorize=change.authorize)
+            elif change.resource_id:
+                self.resource(change.action, change.resource_type, change.resource_id, change.subject_type,
+                              change.subject_id, manage=change.manage, authorize=change.authorize)
+            else:
+                self.resources(change.action, change.resource_type, change.subject_type, change.subject_id,
+                               manage=change.manage, authorize=change.authorize)
+
+        self._ensure_pool_size(parallelism)
+        pool = ThreadPool(parallelism)
+        try:
+            current = pool.map(read, subjects)
+            changes = []
+            for subject, have, want in zip(subjects, current, grants):
+                changes.extend(diff_permissions(subject, have, want, prune))
+            if not dry_run and changes:
+                logger.debug("applying %s permission changes", len(changes))
+                pool.map(apply_change, changes)
+        finally:
+            pool.close()
+            pool.join()
+        return changes
+
 
 class ChinoAPIRepositories(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPIRepositories, self).__init__(auth, url, timeout, session)
 
-    def list(self, **pars):
+    def list(self, as_dict=None, **pars):
         """
         Gets the list of repository
 
@@ -367,9 +572,9 @@ class ChinoAPIRepositories(ChinoAPIBase):
         inside a property with its name (e.g., ``documents``)
         """
         url = "repositories"
-        return ListResult(Repository, self.apicall('GET', url, params=pars))
+        return self._list_result(Repository, self.apicall('GET', url, params=pars), as_dict)
 
-    def detail(self, repository_id):
+    def detail(self, repository_id, as_dict=None):
         """
         Gets the details of repository.
 
@@ -377,7 +582,7 @@ class ChinoAPIRepositories(ChinoAPIBase):
         :return: (dict) the repository.
         """
         url = "repositories/%s" % repository_id
-        return Repository(**self.apicall('GET', url)['repository'])
+        return self._object(Repository, self.apicall('GET', url)['repository'], as_dict)
 
     def create(self, description):
         """
@@ -421,7 +626,7 @@ class ChinoAPISchemas(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPISchemas, self).__init__(auth, url, timeout, session)
 
-    def list(self, repository_id, **pars):
+    def list(self, repository_id, as_dict=None, **pars):
         """
         Gets the list of docuemnts by schema
 
@@ -430,7 +635,7 @@ class ChinoAPISchemas(ChinoAPIBase):
         :return: dict containing ``count``,``total_count``,``limit``,``offset``,``repositories``
         """
         url = "repositories/%s/schemas" % repository_id
-        return ListResult(Schema, self.apicall('GET', url, params=pars))
+        return self._list_result(Schema, self.apicall('GET', url, params=pars), as_dict)
 
     def create(self, repository, description, fields):
         """
@@ -445,7 +650,7 @@ class ChinoAPISchemas(ChinoAPIBase):
         url = "repositories/%s/schemas" % repository
         return Schema(**self.apicall('POST', url, data=data)['schema'])
 
-    def detail(self, schema_id):
+    def detail(self, schema_id, as_dict=None):
         """
         Details of a schema in a repository.
 
@@ -453,14 +658,16 @@ class ChinoAPISchemas(ChinoAPIBase):
         :return: (dict) the schema.
         """
         url = "schemas/%s" % schema_id
-        return Schema(**self.apicall('GET', url)['schema'])
+        return self._object(Schema, self.apicall('GET', url)['schema'], as_dict)
 
     def update(self, schema_id, **kwargs):
         url = "schemas/%s" % schema_id
+        self._invalidate_schema(schema_id)
         return Schema(**self.apicall('PUT', url, data=kwargs)['schema'])
 
     def delete(self, schema_id, force=False, all_content=False):
         url = "schemas/%s" % schema_id
+        self._invalidate_schema(schema_id)
         params = dict()
         if force:
             params['force'] = 'true'
@@ -470,28 +677,102 @@ class ChinoAPISchemas(ChinoAPIBase):
 
 
 class ChinoAPIDocuments(ChinoAPIBase):
+    # set to False the first time the server refuses a PATCH on a document
+    _patch_supported = True
+
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPIDocuments, self).__init__(auth, url, timeout, session)
 
-    def list(self, schema_id, full_document=False, **pars):
+    def list(self, schema_id, full_document=False, as_dict=None, **pars):
         url = "schemas/%s/documents" % schema_id
         if full_document:
             pars['full_document'] = 'true'
-        return ListResult(Document, self.apicall('GET', url, params=pars))
+        return self._list_result(Document, self.apicall('GET', url, params=pars), as_dict)
 
     def create(self, schema_id, content):
+        self._validate_content(schema_id, content)
         data = dict(content=content)
         url = "schemas/%s/documents" % schema_id
-        return Document(**self.apicall('POST', url, data=data)['document'])
+        res = Document(**self.apicall('POST', url, data=data)['document'])
+        if self.count_cache is not None:
+            self.count_cache.invalidate(schema_id)
+        return res
+
+    def detail(self, document_id, as_dict=None):
+        url = "documents/%s" % document_id
+        data = self.apicall('GET', url)['document']
+        if self.document_cache is not None:
+            self.document_cache.put(document_id, data)
+        return self._object(Document, data, as_dict)
+
+    def update(self, document_id, schema_id=None, **kwargs):
+        """
+        Updates a document.
 
-    def detail(self, document_id):
+        :param document_id: (id) of the document
+        :param schema_id: (id) optional, the schema of the document. It's not sent, it's used for the validation
+        :param kwargs: ``content`` and ``is_active``
+        :return: (Document) the updated document
+        """
         url = "documents/%s" % document_id
-        return Document(**self.apicall('GET', url)['document'])
+        if schema_id and 'content' in kwargs:
+            self._validate_content(schema_id, kwargs['content'])
+        res = Document(**self.apicall('PUT', url, data=kwargs)['document'])
+        self._forget(document_id, res.schema_id)
+        return res
 
-    def update(self, document_id, **kwargs):
-        # data = dict(content=content)
+    def partial_update(self, document_id, **kwargs):
         url = "documents/%s" % document_id
-        return Document(**self.apicall('PUT', url, data=kwargs)['document'])
+        res = Document(**self.apicall('PATCH', url, data=kwargs)['document'])
+        self._forget(document_id, res.schema_id)
+        return res
+
+    def _forget(self, document_id, schema_id=None):
+        """
+        Removes a document changed from the caches. The schema is read from the cached document if not given, the
+        counts of all schemas are dropped if it is unknown
+        """
+        if self.document_cache is not None:
+            document = self.document_cache.remove(document_id)
+            if schema_id is None and document is not None:
+                schema_id = document.get('schema_id')
+        if self.blob_index is not None:
+            # the blob fields may have changed
+            self.blob_index.remove_document(document_id)
+        if self.count_cache is not None:
+            self.count_cache.invalidate(schema_id)
+
+    def diff_update(self, document, content):
+        """
+        Updates a document sending only the fields of ``content`` that differ from the old version.
+
+        The changed fields are sent with ``PATCH``; a full ``PUT`` is done when a field has been removed
+        or when the server does not support partial updates of documents.
+
+        :param document: (Document|dict) the current version of the document, e.g. a cached copy
+        :param content: (dict) the new content
+        :return: (Document) the updated document, ``document`` itself if nothing changed.
+        """
+        if type(document) is dict:
+            document = Document(**document)
+        if document.content is None:
+            old = dict()
+        else:
+            old = document.content.to_dict()
+        changed, removed = _diff_content(old, content)
+        if not changed and not removed:
+            return document
+        self._validate_content(document.schema_id, content)
+        if removed or not self._patch_supported:
+            return self.update(document.document_id, content=content)
+        try:
+            return self.partial_update(document.document_id, content=changed)
+        except CallError as ex:
+            if ex.code not in (405, 501):
+                raise
+            logger.debug("PATCH not supported for documents, using PUT")
+            self._patch_supported = False
+            return self.update(document.document_id, content=content)
 
     def delete(self, document_id, force=False):
         url = "documents/%s" % document_id
@@ -499,57 +780,506 @@ class ChinoAPIDocuments(ChinoAPIBase):
             params = dict(force='true')
         else:
             params = None
-        return self.apicall('DELETE', url, params)
+        res = self.apicall('DELETE', url, params)
+        self._forget(document_id)
+        return res
+
+
+# 1MB, a chunk is a call, bigger chunks mean less round trips
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+def _read_blocks(source, chunk_size):
+    """
+    Reads a file, a file-like object or an iterable of bytes in blocks of ``chunk_size`` into a single buffer,
+    yields (offset, memoryview) of each block. Only the last block can be shorter than ``chunk_size``.
+    The buffer is reused: a block is valid only until the next one is read.
+    """
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    offset = 0
+    for length in _fill(source, buf, view):
+        yield offset, view[:length]
+        offset += length
+
+
+def _fill(source, buf, view):
+    """
+    Fills ``buf`` with data from ``source`` and yields how many bytes it contains, every time it's full and at the
+    end. Pipes and sockets may return less than asked, so it reads until the buffer is full.
+    """
+    size = len(buf)
+    if isinstance(source, basestring):
+        source = io.BytesIO(source)
+    if hasattr(source, 'readinto'):
+        while True:
+            filled = 0
+            while filled < size:
+                length = source.readinto(view[filled:])
+                # if we are at the end of the file, than stop
+                if not length:
+                    break
+                filled += length
+            if filled:
+                yield filled
+            if filled < size:
+                return
+    elif hasattr(source, 'read'):
+        while True:
+            filled = 0
+            while filled < size:
+                data = source.read(size - filled)
+                if not data:
+                    break
+                buf[filled:filled + len(data)] = data
+                filled += len(data)
+            if filled:
+                yield filled
+            if filled < size:
+                return
+    else:
+        filled = 0
+        for data in source:
+            start = 0
+            while start < len(data):
+                end = start + size - filled
+                part = data[start:end]
+                buf[filled:filled + len(part)] = part
+                filled += len(part)
+                start = end
+                if filled == size:
+                    yield filled
+                    filled = 0
+        if filled:
+            yield filled
+
+
+class _UploadJournal(object):
+    """
+    Journal of a blob upload on disk: the first line is the json of the upload (``upload_id`` and the
+    fingerprint of the file), then one line ``offset length`` for each chunk accepted by the server.
+    Lines are only appended, a line cut by a crash is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        # bytes of the complete lines, what follows is cut
+        self._end = 0
+
+    def load(self, fingerprint):
+        """
+        :param fingerprint: (dict) what identifies the upload: document, field, file size and time, chunk size
+        :return: ``upload_id`` and a dict offset -> length of the chunks already sent, or None if there is no
+            journal for this upload
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as rd:
+            lines = rd.read().split('\n')
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return None
+        upload_id = header.pop('upload_id', None)
+        if upload_id is None or header != fingerprint:
+            logger.debug("journal %s is for another upload", self.path)
+            return None
+        done = dict()
+        end = len(lines[0]) + 1
+        # the last line is either empty or cut
+        for line in lines[1:-1]:
+            offset, length = line.split(' ')
+            done[int(offset)] = int(length)
+            end += len(line) + 1
+        self._end = end
+        return upload_id, done
+
+    def create(self, upload_id, fingerprint):
+        header = dict(fingerprint, upload_id=upload_id)
+        self._fd = open(self.path, 'wb')
+        self._fd.write(json.dumps(header) + '\n')
+        self._fd.flush()
+
+    def open(self):
+        # the cut line is dropped, else the next line would be appended to it
+        self._fd = open(self.path, 'r+b')
+        self._fd.seek(self._end)
+        self._fd.truncate()
+
+    def add(self, offset, length):
+        with self._lock:
+            self._fd.write('%d %d\n' % (offset, length))
+            self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _blob_filename(res):
+    return res.headers['Content-Disposition'].split(';')[1].split('=')[1]
+
+
+def _write_checked(chunks, wr, filename, sha1=None, md5=None, progress=None, total=None):
+    """
+    Writes the chunks hashing them, then checks the hashes against the expected ones. With ``wr`` None the chunks
+    are only hashed.
+
+    :return: (BlobDownload)
+    """
+    sha1_hash = hashlib.sha1()
+    md5_hash = hashlib.md5()
+    received = 0
+    for data in chunks:
+        if wr is not None:
+            wr.write(data)
+        sha1_hash.update(data)
+        md5_hash.update(data)
+        received += len(data)
+        if progress:
+            progress(received, total)
+    result = BlobDownload(filename=filename, bytes=received, sha1=sha1_hash.hexdigest(), md5=md5_hash.hexdigest())
+    if (sha1 and sha1 != result.sha1) or (md5 and md5 != result.md5):
+        raise CallFail(500, 'The file was not downloaded correctly')
+    return result
+
+
+def _range_total(res, start):
+    """
+    :return: the size of the blob if ``res`` is the answer to a range request starting at ``start``, else None
+    """
+    if res.status_code != 206:
+        return None
+    content_range = res.headers.get('Content-Range', '')
+    if not content_range.startswith('bytes %d-' % start):
+        return None
+    total = content_range.rsplit('/', 1)[-1]
+    if not total.isdigit():
+        return None
+    return int(total)
+
+
+class _Throttle(object):
+    """
+    Limits the bytes per second sent by many threads: each block waits for its turn, given by the bytes sent before
+    """
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, length):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + length / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def blocks(self, blocks):
+        for offset, block in blocks:
+            self.wait(len(block))
+            yield offset, block
 
 
 class ChinoAPIBlobs(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPIBlobs, self).__init__(auth, url, timeout, session)
 
-    def send(self, document_id, blob_field_name, file_path, chunk_size=12 * 1024):
+    def send(self, document_id, blob_field_name, file_path, chunk_size=DEFAULT_CHUNK_SIZE, parallelism=1,
+             retries=2, journal=None):
+        """
+        Uploads a file as blob of the document, SHA-1 and MD5 are checked against the ones of the server.
+
+        :param document_id: (id) of the document
+        :param blob_field_name: (str) the name of the blob field
+        :param file_path: (str) path of the file
+        :param chunk_size: (int) size of the chunks sent
+        :param parallelism: (int) number of chunks uploaded at the same time
+        :param retries: (int) how many times a chunk is sent again if the call fails for a network or server error
+        :param journal: (str) optional, path of a file where the progress of the upload is saved. If the upload is
+            interrupted, calling ``send`` again with the same journal sends only the missing chunks
+        :return: (BlobDetail) the blob
+        """
         if not os.path.exists(file_path):
             raise ClientError("File not found")
-        # start the blob
-        blob_data = self.start(document_id, blob_field_name, os.path.basename(file_path))
-        # get the id and initial offset
-        upload_id = blob_data['upload_id']
-        offset = 0
-        # open the file and start reading it
-        logger.debug("file size %s", os.path.getsize(file_path))
-        rd = open(file_path, "rb")
+        if self.blob_index is not None:
+            known = self._indexed(document_id, blob_field_name, file_path, chunk_size)
+            if known:
+                logger.debug("%s is already in %s of %s", file_path, blob_field_name, document_id)
+                return known
+        if journal:
+            result = self._send_resumable(document_id, blob_field_name, file_path, chunk_size, parallelism, retries,
+                                          _UploadJournal(journal))
+        else:
+            # start the blob
+            blob_data = self.start(document_id, blob_field_name, os.path.basename(file_path))
+            # get the id and initial offset
+            upload_id = blob_data['upload_id']
+            logger.debug("file size %s", os.path.getsize(file_path))
+            with open(file_path, 'rb') as rd:
+                sha1, md5 = self._send_blocks(upload_id, _read_blocks(rd, chunk_size), parallelism, retries)
+            # commit and check if everything was fine
+            result = self._commit_checked(upload_id, sha1, md5)
+        self._index(result, blob_field_name, file_path)
+        return result
+
+    def _indexed(self, document_id, blob_field_name, file_path, chunk_size):
+        """
+        :return: (BlobDetail) the blob already in the field of the document with the content of the file, or None.
+            The file is read only if the field holds a blob of the same size, else it is hashed while it is sent.
+        """
+        stat = os.stat(file_path)
+
+        def sha1():
+            hashes = self.blob_index.file_hashes(file_path, stat.st_size, stat.st_mtime)
+            if hashes is None:
+                sha1 = hashlib.sha1()
+                md5 = hashlib.md5()
+                with open(file_path, 'rb') as rd:
+                    for offset, block in _read_blocks(rd, chunk_size):
+                        sha1.update(block)
+                        md5.update(block)
+                hashes = sha1.hexdigest(), md5.hexdigest()
+                self.blob_index.set_file_hashes(file_path, stat.st_size, stat.st_mtime, *hashes)
+            return hashes[0]
+
+        return self.blob_index.lookup(document_id, blob_field_name, stat.st_size, sha1, self._exists)
+
+    def _exists(self, blob_id):
+        """
+        :return: False if the blob has been deleted, only the first byte is read
+        """
+        try:
+            self._get_blob(blob_id, headers={'Range': 'bytes=0-0'}).close()
+        except CallError as ex:
+            if ex.code == 404:
+                return False
+            raise
+        return True
+
+    def _index(self, blob, blob_field_name, file_path=None):
+        if self.blob_index is None:
+            return
+        self.blob_index.add(blob, blob_field_name)
+        if file_path:
+            stat = os.stat(file_path)
+            self.blob_index.set_file_hashes(file_path, stat.st_size, stat.st_mtime, blob.sha1, blob.md5)
+
+    def send_stream(self, document_id, blob_field_name, file_name, source, chunk_size=DEFAULT_CHUNK_SIZE,
+                    parallelism=1, retries=2):
+        """
+        Uploads a blob from memory, a stream or a generator, without writing it to a file.
+        At most ``chunk_size`` bytes are buffered (one chunk per thread more with ``parallelism``), SHA-1 and MD5 are
+        computed while sending and checked against the ones of the server.
+
+        :param document_id: (id) of the document
+        :param blob_field_name: (str) the name of the blob field
+        :param file_name: (str) the name of the file
+        :param source: bytes, an object with ``read`` (file, socket, response) or an iterable of bytes
+        :param chunk_size: (int) size of the chunks sent
+        :param parallelism: (int) number of chunks uploaded at the same time
+        :param retries: (int) how many times a chunk is sent again if the call fails for a network or server error
+        :return: (BlobDetail) the blob
+        """
+        upload_id = self.start(document_id, blob_field_name, file_name)['upload_id']
+        sha1, md5 = self._send_blocks(upload_id, _read_blocks(source, chunk_size), parallelism, retries)
+        result = self._commit_checked(upload_id, sha1, md5)
+        self._index(result, blob_field_name)
+        return result
+
+    def send_many(self, manifest, parallelism=4, chunk_size=DEFAULT_CHUNK_SIZE, max_bytes_per_second=None,
+                  progress=None, retries=2):
+        """
+        Uploads many files, ``parallelism`` at the same time. Each file is sent as with ``send``, at most
+        ``parallelism`` files are open at once. An error does not stop the other uploads, it's returned in place
+        of the blob.
+
+        :param manifest: list of (document_id, blob_field_name, file_path), or dict file_path -> (document_id,
+            blob_field_name) e.g. built from the files of a directory
+        :param parallelism: (int) number of files uploaded at the same time
+        :param chunk_size: (int) size of the chunks sent
+        :param max_bytes_per_second: (int) optional, limit of the bytes sent per second by all the uploads
+        :param progress: optional, function called after each chunk with the path of the file, the bytes of the file
+            sent so far, the size of the file, the bytes of all the files sent so far and the size of all the files
+        :param retries: (int) how many times a chunk is sent again if the call fails for a network or server error
+        :return: list with a ``BlobDetail`` or the exception for each entry of the manifest, in the same order.
+            If the manifest is a dict, a dict file_path -> ``BlobDetail`` or exception
+        """
+        if isinstance(manifest, dict):
+            items = [(document_id, field, file_path) for file_path, (document_id, field) in manifest.items()]
+        else:
+            items = list(manifest)
+        sizes = [os.path.getsize(file_path) if os.path.isfile(file_path) else 0 for _, _, file_path in items]
+        total = sum(sizes)
+        throttle = _Throttle(max_bytes_per_second) if max_bytes_per_second else None
+        sent_all = [0]
+        lock = threading.Lock()
+
+        def upload(job):
+            (document_id, field, file_path), size = job
+            sent = [0]
+
+            def on_sent(offset, length):
+                with lock:
+                    sent[0] += length
+                    sent_all[0] += length
+                    if progress:
+                        progress(file_path, sent[0], size, sent_all[0], total)
 
+            try:
+                if not os.path.exists(file_path):
+                    raise ClientError("File not found")
+                if self.blob_index is not None:
+                    known = self._indexed(document_id, field, file_path, chunk_size)
+                    if known:
+                        on_sent(0, size)
+                        return known
+                upload_id = self.start(document_id, field, os.path.basename(file_path))['upload_id']
+                with open(file_path, 'rb') as rd:
+                    blocks = _read_blocks(rd, chunk_size)
+                    if throttle:
+                        blocks = throttle.blocks(blocks)
+                    sha1, md5 = self._send_blocks(upload_id, blocks, retries=retries, on_sent=on_sent)
+                result = self._commit_checked(upload_id, sha1, md5)
+                self._index(result, field, file_path)
+                return result
+            except Exception as ex:
+                logger.debug("upload of %s failed: %s", file_path, ex)
+                return ex
+
+        self._ensure_pool_size(parallelism)
+        pool = ThreadPool(parallelism)
+        try:
+            results = pool.map(upload, zip(items, sizes))
+        finally:
+            pool.close()
+            pool.join()
+        if isinstance(manifest, dict):
+            return dict((file_path, result) for (_, _, file_path), result in zip(items, results))
+        return results
+
+    def _send_resumable(self, document_id, blob_field_name, file_path, chunk_size, parallelism, retries, journal):
+        stat = os.stat(file_path)
+        fingerprint = dict(document_id=document_id, field=blob_field_name, size=stat.st_size, mtime=stat.st_mtime,
+                           chunk_size=chunk_size)
+        previous = journal.load(fingerprint)
+        if previous:
+            upload_id, done = previous
+            logger.debug("resuming upload %s, %s chunks already sent", upload_id, len(done))
+            journal.open()
+        else:
+            upload_id = self.start(document_id, blob_field_name, os.path.basename(file_path))['upload_id']
+            done = dict()
+            journal.create(upload_id, fingerprint)
+        try:
+            with open(file_path, 'rb') as rd:
+                sha1, md5 = self._send_blocks(upload_id, _read_blocks(rd, chunk_size), parallelism, retries,
+                                              skip=done, on_sent=journal.add)
+            result = self._commit_checked(upload_id, sha1, md5)
+        except CallError as ex:
+            journal.close()
+            if previous and ex.code == 404:
+                # the upload expired on the server, start from scratch
+                logger.debug("upload %s not found, restarting it", upload_id)
+                journal.remove()
+                return self._send_resumable(document_id, blob_field_name, file_path, chunk_size, parallelism,
+                                            retries, journal)
+            raise
+        except:
+            journal.close()
+            raise
+        journal.remove()
+        return result
+
+    def _send_blocks(self, upload_id, blocks, parallelism=1, retries=2, skip=None, on_sent=None):
+        """
+        Sends the blocks as chunks, hashing them in the same pass. The blocks are read and hashed in order,
+        with ``parallelism`` > 1 they are sent by a pool of threads, each chunk has its offset so the order of
+        the calls does not matter.
+
+        :param blocks: iterable of (offset, data)
+        :param skip: dict offset -> length of the chunks already sent, they are only hashed
+        :param on_sent: function called with offset and length of each chunk sent
+        :return: hex digest of SHA-1 and MD5
+        """
         sha1 = hashlib.sha1()
-        chunk = ""
-        length = 0
-        offset = 0
-        # read all the file
-        with open(file_path, 'rb') as rd:
-            # forever
-            while True:
-                byte = rd.read(1)
-                # if we are at the end of the file, than break
-                if not byte:
+        md5 = hashlib.md5()
+        if parallelism <= 1:
+            for offset, block in blocks:
+                sha1.update(block)
+                md5.update(block)
+                if skip and skip.get(offset) == len(block):
+                    continue
+                self._chunk_retry(upload_id, block, offset, retries)
+                if on_sent:
+                    on_sent(offset, len(block))
+            return sha1.hexdigest(), md5.hexdigest()
+
+        self._ensure_pool_size(parallelism)
+        # at most 2 chunks per thread are in memory: one being sent and one waiting
+        slots = threading.BoundedSemaphore(parallelism * 2)
+        errors = []
+
+        def send(offset, data):
+            try:
+                if not errors:
+                    self._chunk_retry(upload_id, data, offset, retries)
+                    if on_sent:
+                        on_sent(offset, len(data))
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                slots.release()
+
+        pool = ThreadPool(parallelism)
+        try:
+            for offset, block in blocks:
+                if errors:
                     break
-                # read the byte
-                length += 1
-                chunk += byte
-                # if we have read enough bytes
-                if length == chunk_size:
-                    # send a chunk
-                    self.chunk(upload_id, chunk, length=length, offset=offset)
-                    # update the hash
-                    sha1.update(chunk)
-                    chunk = ""
-                    offset += length
-                    length = 0
-        if length != 0:
-            # send the last chunk
-            self.chunk(upload_id, chunk, length=length, offset=offset)
-            sha1.update(chunk)
-        rd.close()
-        # commit and check if everything was fine
+                if skip and skip.get(offset) == len(block):
+                    sha1.update(block)
+                    md5.update(block)
+                    continue
+                # the block may be a view on a buffer that is going to be reused
+                if isinstance(block, memoryview):
+                    block = block.tobytes()
+                sha1.update(block)
+                md5.update(block)
+                slots.acquire()
+                pool.apply_async(send, (offset, block))
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise errors[0]
+        return sha1.hexdigest(), md5.hexdigest()
+
+    def _chunk_retry(self, upload_id, data, offset, retries):
+        attempt = 0
+        while True:
+            try:
+                return self.chunk(upload_id, data, length=len(data), offset=offset)
+            except (CallError, requests.RequestException) as ex:
+                # errors of the client (4xx) are not going to change
+                if attempt >= retries or (isinstance(ex, CallError) and 400 <= ex.code < 500):
+                    raise
+                attempt += 1
+                logger.debug("chunk at %s failed (%s), retry %s", offset, ex, attempt)
+                time.sleep(0.5 * attempt)
+
+    def _commit_checked(self, upload_id, sha1, md5):
         commit = self.commit(upload_id)
-        if sha1.hexdigest() != commit['sha1']:
+        if sha1 != commit['sha1'] or md5 != commit['md5']:
             raise CallFail(500, 'The file was not uploaded correctly')
         return BlobDetail(**commit)
 
@@ -570,57 +1300,657 @@ class ChinoAPIBlobs(ChinoAPIBase):
         return self.apicall('POST', url, data=data)['blob']
 
     def detail(self, blob_id):
+        found = self._cached(blob_id) if self.blob_cache is not None else None
+        if found is not None:
+            filename, rd = found
+            with rd:
+                return Blob(filename=filename, content=rd.read())
         # NOTE: this calls directly the function. needed to get the headers
         url = 'blobs/%s' % blob_id
         # this is different
         res = self.apicall('GET', url, raw=True)
-        fname = res.headers['Content-Disposition'].split(';')[1].split('=')[1]
-        return Blob(filename=fname, content=res.content)
+        return Blob(filename=_blob_filename(res), content=res.content)
+
+    def open(self, blob_id, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Opens a blob as a file, without loading it in memory. With the blob cache the file is the one in the cache,
+        it is downloaded only if it is not there; else the blob is downloaded into a temporary file.
+
+        :param blob_id: (id) of the blob
+        :param chunk_size: (int) bytes read at a time from the network
+        :return: (Blob) filename and the file opened for reading as content, to be closed by the caller
+        """
+        found = self._cached(blob_id, chunk_size) if self.blob_cache is not None else None
+        if found is not None:
+            return Blob(filename=found[0], content=found[1])
+        wr = tempfile.TemporaryFile()
+        try:
+            result = self._save(self._get_blob(blob_id), wr, chunk_size, None, None, None)
+            wr.seek(0)
+        except:
+            wr.close()
+            raise
+        return Blob(filename=result.filename, content=wr)
+
+    def _cached(self, blob_id, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :return: filename and the file of the blob in the cache opened for reading, it is downloaded if missing.
+            None if the blob is larger than the cache, it is then read without the cache
+        """
+        found = self.blob_cache.open(blob_id)
+        if found is None:
+            found = self._fill_cache(blob_id, chunk_size)
+        return found
+
+    def _fill_cache(self, blob_id, chunk_size):
+        """
+        Downloads a blob that is not in the cache into it.
+
+        :return: filename and the file of the blob opened for reading, None if it does not fit in the cache
+        """
+        res = self._get_blob(blob_id)
+        total = res.headers.get('Content-Length')
+        if total is not None and int(total) > self.blob_cache.max_bytes:
+            res.close()
+            return None
+        wr = self.blob_cache.temp_file()
+        try:
+            with wr:
+                result = self._save(res, wr, chunk_size, None, None, None)
+            path = self.blob_cache.add(blob_id, result.filename, wr.name)
+        finally:
+            if os.path.exists(wr.name):
+                os.remove(wr.name)
+        if path is None:
+            return None
+        try:
+            return result.filename, open(path, 'rb')
+        except IOError:
+            # already evicted by another thread
+            return None
+
+    def download(self, blob_id, dest, chunk_size=DEFAULT_CHUNK_SIZE, sha1=None, md5=None, progress=None,
+                 parallelism=1, retries=2):
+        """
+        Downloads a blob into a file, reading it from the network one chunk at a time.
+
+        :param blob_id: (id) of the blob
+        :param dest: path of the file, it is written only when the download is complete, or an object with ``write``
+        :param chunk_size: (int) bytes read at a time
+        :param sha1: (str) optional, expected SHA-1 of the blob (e.g. from ``BlobDetail``)
+        :param md5: (str) optional, expected MD5 of the blob
+        :param progress: optional, function called with the bytes received so far and the total (None if unknown)
+        :param parallelism: (int) if > 1 and ``dest`` is a path, segments of the blob are downloaded at the same time
+            with range requests. If the server does not support ranges the blob is downloaded as a single stream
+        :param retries: (int) with ``parallelism``, how many times a segment is downloaded again if it fails
+        :return: (BlobDownload) filename, bytes, sha1 and md5 of the blob
+        """
+        if self.blob_cache is not None:
+            return self._download_cached(blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries)
+        return self._download(blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries)
+
+    def _download(self, blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries):
+        if parallelism > 1 and not hasattr(dest, 'write'):
+            return self._download_ranges(blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries)
+        return self._save(self._get_blob(blob_id), dest, chunk_size, sha1, md5, progress)
+
+    def _download_cached(self, blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries):
+        found = self.blob_cache.open(blob_id)
+        if found is None:
+            if hasattr(dest, 'write'):
+                # the blob goes to the cache first, then it's copied
+                found = self._fill_cache(blob_id, chunk_size)
+                if found is None:
+                    return self._download(blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries)
+            else:
+                result = self._download(blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries)
+                self.blob_cache.add_file(blob_id, result.filename, dest)
+                return result
+        filename, rd = found
+        with rd:
+            chunks = iter(lambda: rd.read(chunk_size), b'')
+            total = os.fstat(rd.fileno()).st_size
+            if hasattr(dest, 'write'):
+                return _write_checked(chunks, dest, filename, sha1, md5, progress, total)
+            partial = dest + '.part'
+            try:
+                with open(partial, 'wb') as wr:
+                    result = _write_checked(chunks, wr, filename, sha1, md5, progress, total)
+            except:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+        _replace(partial, dest)
+        return result
+
+    def _save(self, res, dest, chunk_size, sha1, md5, progress):
+        """
+        Writes the body of the response ``res`` into ``dest``, see ``download``
+        """
+        try:
+            total = res.headers.get('Content-Length')
+            if total is not None:
+                total = int(total)
+            filename = _blob_filename(res)
+            if hasattr(dest, 'write'):
+                result = _write_checked(res.iter_content(chunk_size), dest, filename, sha1, md5, progress, total)
+            else:
+                partial = dest + '.part'
+                try:
+                    with open(partial, 'wb') as wr:
+                        result = _write_checked(res.iter_content(chunk_size), wr, filename, sha1, md5, progress,
+                                                total)
+                except:
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    raise
+                _replace(partial, dest)
+        finally:
+            res.close()
+        return result
+
+    def _download_ranges(self, blob_id, dest, chunk_size, sha1, md5, progress, parallelism, retries):
+        # the first segment tells if ranges are supported and the size of the blob
+        first = self._get_blob(blob_id, headers={'Range': 'bytes=0-%d' % (chunk_size - 1)})
+        total = _range_total(first, 0)
+        if total is None or total <= chunk_size:
+            # no ranges, or the first segment is the whole blob
+            logger.debug("downloading blob %s as a single stream", blob_id)
+            return self._save(first, dest, chunk_size, sha1, md5, progress)
+        filename = _blob_filename(first)
+        # segments are smaller than total / parallelism, so a slow one does not keep the others waiting
+        segment = max(chunk_size, total // (parallelism * 4) + 1)
+        segments = [(0, chunk_size - 1)]
+        for start in xrange(chunk_size, total, segment):
+            segments.append((start, min(start + segment, total) - 1))
+        received = [0]
+        lock = threading.Lock()
+
+        def add(length):
+            with lock:
+                received[0] += length
+                if progress:
+                    progress(received[0], total)
+
+        partial = dest + '.part'
+
+        def fetch(segment_range, res=None):
+            start, end = segment_range
+            attempt = 0
+            while True:
+                written = 0
+                try:
+                    if res is None:
+                        res = self._get_blob(blob_id, headers={'Range': 'bytes=%d-%d' % (start, end)})
+                    if _range_total(res, start) != total:
+                        raise CallError(res.status_code, 'Range bytes=%d-%d not returned' % (start, end))
+                    with open(partial, 'r+b') as wr:
+                        wr.seek(start)
+                        for data in res.iter_content(chunk_size):
+                            wr.write(data)
+                            written += len(data)
+                            add(len(data))
+                    if written != end - start + 1:
+                        raise CallError(500, 'Range bytes=%d-%d is incomplete' % (start, end))
+                    return
+                except (CallError, requests.RequestException) as ex:
+                    add(-written)
+                    if attempt >= retries:
+                        raise
+                    attempt += 1
+                    logger.debug("segment at %s failed (%s), retry %s", start, ex, attempt)
+                    time.sleep(0.5 * attempt)
+                finally:
+                    if res is not None:
+                        res.close()
+                    res = None
+
+        self._ensure_pool_size(parallelism)
+        try:
+            # the file is allocated, then each segment is written in its place
+            with open(partial, 'wb') as wr:
+                wr.truncate(total)
+            jobs = [(segments[0], first)] + [(segment_range, None) for segment_range in segments[1:]]
+            pool = ThreadPool(parallelism)
+            try:
+                pool.map(lambda job: fetch(*job), jobs)
+            finally:
+                pool.close()
+                pool.join()
+            # hashes are computed on the complete file
+            with open(partial, 'rb') as rd:
+                result = _write_checked(iter(lambda: rd.read(chunk_size), ''), None, filename, sha1, md5)
+        except:
+            first.close()
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        _replace(partial, dest)
+        return result
+
+    def iter_content(self, blob_id, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Downloads a blob one chunk at a time.
+
+        :param blob_id: (id) of the blob
+        :param chunk_size: (int) bytes read at a time
+        :return: generator of bytes
+        """
+        if self.blob_cache is not None:
+            found = self.blob_cache.open(blob_id)
+            if found is not None:
+                with found[1] as rd:
+                    for data in iter(lambda: rd.read(chunk_size), b''):
+                        yield data
+                return
+        res = self._get_blob(blob_id)
+        try:
+            for data in res.iter_content(chunk_size):
+                yield data
+        finally:
+            res.close()
+
+    def _get_blob(self, blob_id, headers=None):
+        res = self.apicall('GET', 'blobs/%s' % blob_id, raw=True, stream=True, headers=headers)
+        try:
+            # 206 is the answer to a range request
+            if res.status_code != 206:
+                self.valid_call(res)
+        except:
+            res.close()
+            raise
+        return res
 
     def delete(self, blob_id):
         url = 'blobs/%s' % blob_id
-        return self.apicall('DELETE', url)
+        res = self.apicall('DELETE', url)
+        if self.blob_index is not None:
+            self.blob_index.remove(blob_id)
+        if self.blob_cache is not None:
+            self.blob_cache.remove(blob_id)
+        return res
 
 
 class ChinoAPISearches(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPISearches, self).__init__(auth, url, timeout, session)
+        self.plan_cache = PlanCache()
 
-    def search(self, schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None, **kwargs):
+    def search(self, schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None, as_dict=None,
+               **kwargs):
         sys.stderr.write("DEPRECATE: This method is going to be removed soon, please use .documents")
-        return self.documents(schema_id, result_type, filter_type, sort, filters, **kwargs)
+        return self.documents(schema_id, result_type, filter_type, sort, filters, as_dict, **kwargs)
 
-    def documents(self, schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None, **kwargs):
-        url = 'search/documents/%s'%schema_id
-        if not sort:
-            sort = []
-        if not filters:
-            filters = []
-        data = dict(result_type=result_type, filter_type=filter_type, filter=filters)
-        if sort:
-            data['sort'] = sort
-        if result_type == "COUNT":
-            return self.apicall('POST', url, data=data, params=kwargs)['count']
-        elif result_type == "ONLY_ID":
-            return ListResult(IDs, self.apicall('POST', url, data=data, params=kwargs))
+    def documents(self, schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None, as_dict=None,
+                  fresh=False, **kwargs):
+        """
+        Searches the documents of a schema.
+
+        :param fresh: (bool) with ``COUNT`` and the count cache of the client, if True the count is read from the
+            server even if it is in the cache
+        """
+        plan = self.plan('documents', schema_id, result_type, filter_type, sort, filters, check=self.validate)
+        if result_type == "COUNT" and self.count_cache is not None:
+            if not fresh:
+                count = self.count_cache.get(schema_id, plan.body)
+                if count is not None:
+                    return count
+            count = self.run(plan, as_dict, **kwargs)
+            self.count_cache.put(schema_id, plan.body, count)
+            return count
+        return self.run(plan, as_dict, **kwargs)
+
+    def users(self, user_schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None, as_dict=None,
+              **kwargs):
+        """
+        Searches the users of a user schema. With the username index of the client, ``USERNAME_EXISTS`` searches
+        of a username that is surely not taken return False without calling the API.
+        """
+        plan = self.plan('users', user_schema_id, result_type, filter_type, sort, filters, check=self.validate)
+        if result_type == "USERNAME_EXISTS" and self.username_index is not None:
+            username = self._searched_username(plan)
+            if username is not None and not self.username_index.may_exist(
+                    user_schema_id, username, lambda: self._usernames(user_schema_id)):
+                return False
+        return self.run(plan, as_dict, **kwargs)
+
+    @staticmethod
+    def _searched_username(plan):
+        """
+        :return: the username of a search with the single filter username = value, else None
+        """
+        filters = json.loads(plan.body)['filter']
+        if len(filters) == 1 and filters[0].get('field') == 'username' and filters[0].get('type') == 'eq' and \
+                isinstance(filters[0].get('value'), basestring):
+            return filters[0]['value']
+        return None
+
+    def _usernames(self, user_schema_id):
+        count = self.users(user_schema_id, "COUNT")
+        users = self.iter_plan(self.plan('users', user_schema_id), prefetch=True, as_dict=True)
+        return count, (user['username'] for user in users)
+
+    def iter_documents(self, schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None,
+                       page_size=100, prefetch=False, as_dict=None):
+        """
+        Iterates over all the documents found, the pages are requested while iterating: if the loop stops,
+        the next pages are not requested.
+
+        :param page_size: (int) documents requested per call
+        :param prefetch: (bool) if True the next page is requested while the current one is consumed
+        :return: generator of ``Document`` (``IDs`` with ``ONLY_ID``, dict with ``as_dict``)
+        """
+        plan = self.plan('documents', schema_id, result_type, filter_type, sort, filters, check=self.validate)
+        return self.iter_plan(plan, page_size, prefetch, as_dict)
+
+    def iter_users(self, user_schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None,
+                   page_size=100, prefetch=False, as_dict=None):
+        """
+        Iterates over all the users found, see ``iter_documents``
+
+        :return: generator of ``User`` (dict with ``as_dict``)
+        """
+        plan = self.plan('users', user_schema_id, result_type, filter_type, sort, filters, check=self.validate)
+        return self.iter_plan(plan, page_size, prefetch, as_dict)
+
+    def iter_plan(self, plan, page_size=100, prefetch=False, as_dict=None):
+        """
+        Iterates over the items found by a compiled search, see ``iter_documents``
+        """
+        if plan.result_type in ("COUNT", "EXISTS", "USERNAME_EXISTS"):
+            raise ClientError("%s searches have no items to iterate" % plan.result_type)
+        return (item for page in self._pages(plan, page_size, prefetch, as_dict) for item in page)
+
+    def _pages(self, plan, page_size, prefetch, as_dict):
+        """
+        Generator of the lists of items of each page
+        """
+        name = self._result_class(plan).__str_names__
+
+        def fetch(offset):
+            return self.run(plan, as_dict, offset=offset, limit=page_size)
+
+        pool = ThreadPool(1) if prefetch else None
+        try:
+            offset = 0
+            page = fetch(offset)
+            while True:
+                found = getattr(page, name)
+                offset += len(found)
+                more = len(found) > 0 and offset < page.paging.total_count
+                pending = pool.apply_async(fetch, (offset,)) if more and pool else None
+                yield found
+                if not more:
+                    return
+                page = pending.get() if pending else fetch(offset)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def scan(self, schema_id, field, partitions=4, bounds=None, filters=None, result_type="FULL_CONTENT",
+             ordered=False, page_size=100, as_dict=None):
+        """
+        Reads all the documents found splitting the search in partitions by ranges of ``field``. The partitions are
+        read at the same time, each one from offset 0, so no call has a large offset. Documents with no value in
+        ``field`` are not in any range and are not returned.
+
+        :param field: (str) an indexed field, the ranges are on its values
+        :param partitions: (int) number of partitions, the ranges are computed from the smallest and largest value of
+            ``field`` (integer, float, date or datetime fields, or ``insert_date`` and ``last_update``)
+        :param bounds: list of values splitting the ranges, instead of ``partitions``: [10, 20] reads the documents
+            with ``field`` < 10, >= 10 and < 20, >= 20 at the same time
+        :param filters: other filters, they are all required (``and``)
+        :param ordered: (bool) if True the documents are sorted by ``field``, else they are returned as soon as
+            a page of any partition is read
+        :return: generator of ``Document`` (``IDs`` with ``ONLY_ID``, dict with ``as_dict``)
+        """
+        filters = list(filters or [])
+        if bounds is None:
+            bounds = self._scan_bounds(schema_id, field, partitions, filters)
+        sort = [dict(field=field, order='asc')] if ordered else None
+        plans = [self.plan('documents', schema_id, result_type, 'and', sort, filters + extra, check=self.validate)
+                 for extra in range_filters(field, sorted(bounds))]
+        return self._scan(plans, ordered, page_size, as_dict)
+
+    def _scan_bounds(self, schema_id, field, partitions, filters):
+        values = []
+        for order in ('asc', 'desc'):
+            res = self.documents(schema_id, filters=filters, sort=[dict(field=field, order=order)], as_dict=True,
+                                 limit=1)
+            if not res.documents:
+                return []
+            values.append(field_value(res.documents[0], field))
+        try:
+            return split_range(values[0], values[1], partitions)
+        except ValueError:
+            raise ClientError("The ranges of %s can't be computed, pass bounds" % field)
+
+    def _scan(self, plans, ordered, page_size, as_dict):
+        # each partition has its queue if the order matters, else they share one
+        if ordered:
+            queues = [Queue(maxsize=2) for _ in plans]
         else:
-            return ListResult(Document, self.apicall('POST', url, data=data, params=kwargs))
+            queues = [Queue(maxsize=2 * len(plans))] * len(plans)
+        stop = threading.Event()
+
+        def put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def read(i):
+            try:
+                for found in self._pages(plans[i], page_size, False, as_dict):
+                    if not put(queues[i], ('page', found)):
+                        return
+                put(queues[i], ('done', None))
+            except Exception as ex:
+                put(queues[i], ('error', ex))
+
+        def items():
+            self._ensure_pool_size(len(plans))
+            pool = ThreadPool(len(plans))
+            try:
+                for i in xrange(len(plans)):
+                    pool.apply_async(read, (i,))
+                running = len(plans)
+                i = 0
+                while running:
+                    kind, value = queues[i].get()
+                    if kind == 'page':
+                        for item in value:
+                            yield item
+                        continue
+                    if kind == 'error':
+                        raise value
+                    running -= 1
+                    if ordered:
+                        i += 1
+            finally:
+                stop.set()
+                pool.close()
+                pool.join()
+
+        return items()
+
+    def documents_multi(self, schema_ids, filters=None, sort=None, limit=100, filter_type="and", page_size=100,
+                        as_dict=None):
+        """
+        Searches the documents of many schemas, the first ``limit`` of all of them by ``sort``.
 
-    def users(self, user_schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None, **kwargs):
-        url = 'search/users/%s' % user_schema_id
+        The first page of each schema is read at the same time, then the pages are merged by the sort key: the next
+        page of a schema is read only when its documents are needed, and at most ``limit`` documents are read from
+        each schema.
+
+        :param schema_ids: list of (id) of schemas
+        :param sort: list of dict or ``_SortField``, it is required
+        :param limit: (int) max number of documents returned
+        :param page_size: (int) documents requested per call
+        :return: generator of ``Document`` (dict with ``as_dict``) sorted by ``sort``
+        """
         if not sort:
-            sort = []
-        if not filters:
-            filters = []
-        data = dict(result_type=result_type, filter_type=filter_type, filter=filters)
-        if sort:
-            data['sort'] = sort
-        if result_type == "COUNT":
-            return self.apicall('POST', url, data=data, params=kwargs)['count']
-        elif result_type == "EXISTS" or result_type== "USERNAME_EXISTS":
-            return bool(self.apicall('POST', url, data=data, params=kwargs)['exists'])
+            raise ClientError("documents_multi needs sort")
+        plans = [self.plan('documents', schema_id, "FULL_CONTENT", filter_type, sort, filters, check=self.validate)
+                 for schema_id in schema_ids]
+        key = sort_key(sort)
+
+        def fetch(plan, offset):
+            size = min(page_size, limit - offset)
+            page = self.run(plan, True, offset=offset, limit=size)
+            more = len(page.documents) > 0 and offset + len(page.documents) < min(page.paging.total_count, limit)
+            return page.documents, more
+
+        def items():
+            self._ensure_pool_size(len(plans))
+            pool = ThreadPool(max(len(plans), 1))
+            try:
+                firsts = pool.map(lambda plan: fetch(plan, 0), plans)
+            finally:
+                pool.close()
+                pool.join()
+            heap = []
+            # for each schema: documents of the page, position in the page, offset of the page, more pages
+            streams = []
+            for i, (documents, more) in enumerate(firsts):
+                streams.append([documents, 0, 0, more])
+                if documents:
+                    heap.append((key(documents[0]), i))
+            heapq.heapify(heap)
+            returned = 0
+            while heap and returned < limit:
+                _, i = heapq.heappop(heap)
+                stream = streams[i]
+                documents, position = stream[0], stream[1]
+                yield self._object(Document, documents[position], as_dict)
+                returned += 1
+                position += 1
+                if position == len(documents) and stream[3] and returned < limit:
+                    offset = stream[2] + len(documents)
+                    documents, more = fetch(plans[i], offset)
+                    stream[:] = [documents, 0, offset, more]
+                    position = 0
+                else:
+                    stream[1] = position
+                if position < len(documents):
+                    heapq.heappush(heap, (key(documents[position]), i))
+
+        return items()
+
+    def iter_hydrated(self, schema_id, filter_type="and", sort=None, filters=None, page_size=100, parallelism=4,
+                      as_dict=None):
+        """
+        Iterates over the documents found, as ``iter_documents`` with ``FULL_CONTENT``, but the search returns only
+        the ids: the documents are taken from the document cache of the client, the missing ones are read with
+        ``parallelism`` calls at the same time. Documents are returned in the order of the search, the ones deleted
+        in the meanwhile are skipped.
+
+        :return: generator of ``Document`` (dict with ``as_dict``)
+        """
+        plan = self.plan('documents', schema_id, "ONLY_ID", filter_type, sort, filters, check=self.validate)
+
+        def load(document_id):
+            try:
+                data = self.apicall('GET', "documents/%s" % document_id)['document']
+            except CallError as ex:
+                if ex.code == 404:
+                    return None
+                raise
+            if self.document_cache is not None:
+                self.document_cache.put(document_id, data)
+            return data
+
+        def items():
+            self._ensure_pool_size(parallelism)
+            pool = ThreadPool(parallelism)
+            try:
+                for ids in self._pages(plan, page_size, True, True):
+                    documents = dict()
+                    if self.document_cache is not None:
+                        for document_id in ids:
+                            data = self.document_cache.get(document_id)
+                            if data is not None:
+                                documents[document_id] = data
+                    missing = [document_id for document_id in ids if document_id not in documents]
+                    documents.update(zip(missing, pool.map(load, missing)))
+                    for document_id in ids:
+                        data = documents[document_id]
+                        if data is not None:
+                            yield self._object(Document, data, as_dict)
+            finally:
+                pool.close()
+                pool.join()
+
+        return items()
+
+    def query(self, schema_id, result_type="FULL_CONTENT", filter_type="and"):
+        """
+        :return: (Query) a search on the documents of the schema, see ``chino.query.Query``
+        """
+        return Query(self, 'documents', schema_id, result_type, filter_type)
+
+    def query_users(self, user_schema_id, result_type="FULL_CONTENT", filter_type="and"):
+        """
+        :return: (Query) a search on the users of the user schema, see ``chino.query.Query``
+        """
+        return Query(self, 'users', user_schema_id, result_type, filter_type)
+
+    def plan(self, kind, schema_id, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None,
+             check=False):
+        """
+        Compiles a search, or returns the one already compiled with the same arguments.
+
+        :param kind: 'documents' or 'users'
+        :param sort: list of dict or ``_SortField``
+        :param filters: list of dict or ``_FilterField``
+        :param check: if True the fields and values are checked against the (cached) schema,
+            raising ``ValidationError``
+        :return: (Plan)
+        """
+        key = query_key(kind, schema_id, result_type, filter_type, sort, filters) + (check,)
+
+        def compile_plan():
+            frozen_sort, frozen_filters = key[4], key[5]
+            if check and self.schema_cache is not None:
+                check_query(kind, frozen_filters, frozen_sort, self._schema_fields(kind, schema_id))
+            return Plan(kind, schema_id, result_type, filter_type, frozen_sort, frozen_filters)
+
+        return self.plan_cache.get(key, compile_plan)
+
+    def _schema_fields(self, kind, schema_id):
+        if kind == 'users':
+            url = "user_schemas/%s" % schema_id
+            loader = lambda: self.apicall('GET', url)['user_schema']['structure']['fields']
         else:
-            return ListResult(User, self.apicall('POST', url, data=data, params=kwargs))
+            url = "schemas/%s" % schema_id
+            loader = lambda: self.apicall('GET', url)['schema']['structure']['fields']
+        return self.schema_cache.fields(schema_id, loader)
+
+    def run(self, plan, as_dict=None, **kwargs):
+        """
+        Sends a compiled search.
+
+        :param plan: (Plan) see ``plan``
+        :param kwargs: parameters of the call, e.g. ``offset`` and ``limit``
+        """
+        data = self.apicall('POST', plan.url, data=plan.body, params=kwargs)
+        if plan.result_type == "COUNT":
+            return data['count']
+        if plan.result_type == "EXISTS" or plan.result_type == "USERNAME_EXISTS":
+            return bool(data['exists'])
+        return self._list_result(self._result_class(plan), data, as_dict)
+
+    @staticmethod
+    def _result_class(plan):
+        if plan.kind == 'users':
+            return User
+        if plan.result_type == "ONLY_ID":
+            return IDs
+        return Document
 
 
 class ChinoAuth(object):
@@ -685,7 +2015,7 @@ class ChinoAPIUserSchemas(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPIUserSchemas, self).__init__(auth, url, timeout, session)
 
-    def list(self, **pars):
+    def list(self, as_dict=None, **pars):
         """
         Gets the list of UserSchemas
 
@@ -693,7 +2023,7 @@ class ChinoAPIUserSchemas(ChinoAPIBase):
         :return: dict containing ``count``,``total_count``,``limit``,``offset``,``repositories``
         """
         url = "user_schemas"
-        return ListResult(UserSchema, self.apicall('GET', url, params=pars))
+        return self._list_result(UserSchema, self.apicall('GET', url, params=pars), as_dict)
 
     def create(self, description, fields):
         """
@@ -707,7 +2037,7 @@ class ChinoAPIUserSchemas(ChinoAPIBase):
         url = "user_schemas"
         return UserSchema(**self.apicall('POST', url, data=data)['user_schema'])
 
-    def detail(self, user_schema_id):
+    def detail(self, user_schema_id, as_dict=None):
         """
         Details of a UserSchema
 
@@ -715,7 +2045,7 @@ class ChinoAPIUserSchemas(ChinoAPIBase):
         :return: (dict) the schema.
         """
         url = "user_schemas/%s" % user_schema_id
-        return UserSchema(**self.apicall('GET', url)['user_schema'])
+        return self._object(UserSchema, self.apicall('GET', url)['user_schema'], as_dict)
 
     def update(self, user_schema_id, **kwargs):
         """
@@ -725,10 +2055,12 @@ class ChinoAPIUserSchemas(ChinoAPIBase):
         :return:
         """
         url = "user_schemas/%s" % user_schema_id
+        self._invalidate_schema(user_schema_id)
         return UserSchema(**self.apicall('PUT', url, data=kwargs)['user_schema'])
 
     def delete(self, user_schema_id, force=False):
         url = "user_schemas/%s" % user_schema_id
+        self._invalidate_schema(user_schema_id)
         if force:
             params = dict(force='true')
         else:
@@ -740,7 +2072,7 @@ class ChinoAPICollections(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPICollections, self).__init__(auth, url, timeout, session)
 
-    def list(self, **pars):
+    def list(self, as_dict=None, **pars):
         """
         Gets the list of Collections
 
@@ -748,7 +2080,7 @@ class ChinoAPICollections(ChinoAPIBase):
         :return: dict containing ``count``,``total_count``,``limit``,``offset``,``repositories``
         """
         url = "collections"
-        return ListResult(Collection, self.apicall('GET', url, params=pars))
+        return self._list_result(Collection, self.apicall('GET', url, params=pars), as_dict)
 
     def create(self, name):
         """
@@ -761,7 +2093,7 @@ class ChinoAPICollections(ChinoAPIBase):
         url = "collections"
         return Collection(**self.apicall('POST', url, data=data)['collection'])
 
-    def detail(self, collection_id):
+    def detail(self, collection_id, as_dict=None):
         """
         Details of a Collection
 
@@ -769,7 +2101,7 @@ class ChinoAPICollections(ChinoAPIBase):
         :return: (dict) the Collection.
         """
         url = "collections/%s" % collection_id
-        return Collection(**self.apicall('GET', url)['collection'])
+        return self._object(Collection, self.apicall('GET', url)['collection'], as_dict)
 
     def update(self, collection_id, **kwargs):
         url = "collections/%s" % collection_id
@@ -783,9 +2115,9 @@ class ChinoAPICollections(ChinoAPIBase):
             params = None
         return self.apicall('DELETE', url, params)
 
-    def list_documents(self, collection_id, **pars):
+    def list_documents(self, collection_id, as_dict=None, **pars):
         url = "collections/%s/documents" % collection_id
-        return ListResult(Document, self.apicall('GET', url, params=pars))
+        return self._list_result(Document, self.apicall('GET', url, params=pars), as_dict)
 
     def add_document(self, collection_id, document_id):
         url = "collections/%s/documents/%s" % (collection_id, document_id)
@@ -795,17 +2127,17 @@ class ChinoAPICollections(ChinoAPIBase):
         url = "collections/%s/documents/%s" % (collection_id, document_id)
         return self.apicall('DELETE', url)
 
-    def search(self, name, contains=False, **pars):
+    def search(self, name, contains=False, as_dict=None, **pars):
         url = "collections/search"
         data = dict(name=name, contains=contains)
-        return ListResult(Collection, self.apicall('POST', url, params=pars, data=data))
+        return self._list_result(Collection, self.apicall('POST', url, params=pars, data=data), as_dict)
 
 
 class ChinoAPIApplication(ChinoAPIBase):
     def __init__(self, auth, url, timeout, session=True):
         super(ChinoAPIApplication, self).__init__(auth, url, timeout, session)
 
-    def list(self, **pars):
+    def list(self, as_dict=None, **pars):
         """
         Gets the list of Application
 
@@ -813,7 +2145,7 @@ class ChinoAPIApplication(ChinoAPIBase):
         :return: dict containing ``count``,``total_count``,``limit``,``offset``,``repositories``
         """
         url = "auth/applications"
-        return ListResult(Application, self.apicall('GET', url, params=pars))
+        return self._list_result(Application, self.apicall('GET', url, params=pars), as_dict)
 
     def create(self, name, grant_type='password', redirect_url=''):
         """
@@ -826,7 +2158,7 @@ class ChinoAPIApplication(ChinoAPIBase):
         url = "auth/applications"
         return Application(**self.apicall('POST', url, data=data)[Application.__str_name__])
 
-    def detail(self, application_id):
+    def detail(self, application_id, as_dict=None):
         """
         Details of a Application
 
@@ -834,7 +2166,7 @@ class ChinoAPIApplication(ChinoAPIBase):
         :return: (dict) the Application.
         """
         url = "auth/applications/%s" % application_id
-        return Application(**self.apicall('GET', url)[Application.__str_name__])
+        return self._object(Application, self.apicall('GET', url)[Application.__str_name__], as_dict)
 
     def update(self, application_id, **kwargs):
         url = "auth/applications/%s" % application_id
@@ -857,7 +2189,9 @@ class ChinoAPIClient(object):
     users = groups = permissions = repositories = schemas = documents = blobs = searches = None
 
     def __init__(self, customer_id, customer_key=None, bearer_token=None, client_id=None, client_secret=None,
-                 version='v1', url='https://api.chino.io/', timeout=30, session=True):
+                 version='v1', url='https://api.chino.io/', timeout=30, session=True, validate=False, as_dict=False,
+                 blob_index=None, blob_cache=None, document_cache=None, count_cache=None, username_index=None,
+                 permission_index=None):
         """
         Init the class
 
@@ -866,6 +2200,23 @@ class ChinoAPIClient(object):
         :param bearer_token: optional, if specified the auth is as user
         :param version: default is `v1`, change if you know what to do
         :param url: the url, this should be changed only for testing
+        :param validate: if True the content of documents and the attributes of users are checked against
+            the (cached) schema before being sent
+        :param as_dict: if True list, detail and search return the decoded json (dict) instead of objects,
+            each method accepts ``as_dict`` to override it for a single call
+        :param blob_index: optional, a ``BlobIndex`` or the path of its database. Files already sent to the same
+            blob field are not uploaded again, see ``BlobIndex``
+        :param blob_cache: optional, a ``BlobCache`` or the directory of a cache of 1GB. Blobs downloaded are kept
+            on disk, ``detail``, ``open``, ``download`` and ``iter_content`` read them from there
+        :param document_cache: optional, a ``DocumentCache`` or True for one with the default size and ttl. Documents
+            read are kept there and used by ``searches.iter_hydrated``
+        :param count_cache: optional, a ``CountCache`` or True for one with the default ttl. ``COUNT`` searches of
+            documents are kept there, they are dropped when documents of the schema are created, updated or deleted
+        :param username_index: optional, a ``UsernameIndex`` or True for the default one. ``USERNAME_EXISTS`` searches
+            of usernames surely not taken are answered without calling the API
+        :param permission_index: optional, a ``PermissionIndex`` to share with other clients, else the client has its
+            own. It is used by ``permissions.can``, grants and revokes done by the client drop the permissions of the
+            subject
         :return: the class
         """
 
@@ -889,3 +2240,31 @@ class ChinoAPIClient(object):
         self.documents = ChinoAPIDocuments(auth, final_url, timeout=timeout, session=session)
         self.blobs = ChinoAPIBlobs(auth, final_url, timeout=timeout, session=session)
         self.searches = ChinoAPISearches(auth, final_url, timeout=timeout, session=session)
+        # schemas are cached and shared, as the auth
+        self.schema_cache = SchemaCache()
+        self.plan_cache = PlanCache()
+        for api in (self.users, self.applications, self.groups, self.permissions, self.repositories, self.schemas,
+                    self.user_schemas, self.collections, self.documents, self.blobs, self.searches):
+            api.schema_cache = self.schema_cache
+            api.plan_cache = self.plan_cache
+            api.validate = validate
+            api.as_dict = as_dict
+        if blob_index is not None and not isinstance(blob_index, BlobIndex):
+            blob_index = BlobIndex(blob_index)
+        self.blob_index = blob_index
+        self.blobs.blob_index = self.documents.blob_index = blob_index
+        if blob_cache is not None and not isinstance(blob_cache, BlobCache):
+            blob_cache = BlobCache(blob_cache)
+        self.blob_cache = self.blobs.blob_cache = blob_cache
+        if document_cache is True:
+            document_cache = DocumentCache()
+        self.document_cache = self.documents.document_cache = self.searches.document_cache = document_cache
+        if count_cache is True:
+            count_cache = CountCache()
+        self.count_cache = self.documents.count_cache = self.searches.count_cache = count_cache
+        if username_index is True:
+            username_index = UsernameIndex()
+        self.username_index = self.users.username_index = self.searches.username_index = username_index
+        if permission_index is None or permission_index is True:
+            permission_index = PermissionIndex()
+        self.permission_index = self.permissions.permission_index = permission_index
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+local caches used by the client
+~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 by Chino SrlS
+:license: Apache 2.0, see LICENSE for more details.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from exceptions import ClientError
+from objects import BlobDetail
+
+__author__ = 'Stefano Tranquillini <stefano@chino.io>'
+
+
+class BlobIndex(object):
+    """
+    Index of the blobs uploaded, by content (SHA-1), stored in a SQLite file.
+
+    It knows which blob holds a given content in a document field, so sending the same content to the same field
+    again does not upload it, and the hashes of the files already sent, so they are not read again to know them.
+    Chino has no way to copy a blob to another document, so the same content sent to a different document
+    is uploaded. ``stats`` counts what has been avoided.
+    """
+
+    def __init__(self, path=':memory:'):
+        """
+        :param path: path of the SQLite database, default is in memory
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs (blob_id TEXT PRIMARY KEY, sha1 TEXT, md5 TEXT, "
+                             "bytes INTEGER, document_id TEXT, field TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS blobs_content ON blobs (document_id, field, sha1)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                             "sha1 TEXT, md5 TEXT)")
+        self.stats = dict(hits=0, misses=0, bytes_avoided=0, bytes_sent=0, hashes_reused=0)
+
+    def lookup(self, document_id, field, size, sha1, exists=None):
+        """
+        :param size: (int) bytes of the content
+        :param sha1: function returning the SHA-1 of the content, called only if the field holds a blob of the same
+            size, so a file that can't match is not read
+        :param exists: optional, function taking the id of the blob and returning False if it has been deleted or
+            replaced (e.g. by another client), the blob is then forgotten
+        :return: (BlobDetail) the blob with the content in the field of the document, None if not known
+        """
+        with self._lock:
+            row = self._db.execute("SELECT bytes, blob_id, sha1, document_id, md5 FROM blobs "
+                                   "WHERE document_id=? AND field=?", (document_id, field)).fetchone()
+        if row is not None and row[0] == size and row[2] == sha1():
+            if exists is None or exists(row[1]):
+                with self._lock:
+                    self.stats['hits'] += 1
+                    self.stats['bytes_avoided'] += row[0]
+                return BlobDetail(*row)
+            self.remove(row[1])
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def add(self, blob, field):
+        """
+        Adds a blob just uploaded. A field holds one blob, so the blobs before it in the same field are forgotten.
+
+        :param blob: (BlobDetail)
+        :param field: (str) the name of the blob field
+        """
+        with self._lock:
+            self.stats['bytes_sent'] += blob.bytes
+            with self._db:
+                self._db.execute("DELETE FROM blobs WHERE document_id=? AND field=?", (blob.document_id, field))
+                self._db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                                 (blob.blob_id, blob.sha1, blob.md5, blob.bytes, blob.document_id, field))
+
+    def file_hashes(self, path, size, mtime):
+        """
+        :return: SHA-1 and MD5 of the file, if it was hashed before and it has not changed, else None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT sha1, md5 FROM files WHERE path=? AND size=? AND mtime=?",
+                                   (path, size, mtime)).fetchone()
+            if row is not None:
+                self.stats['hashes_reused'] += 1
+            return row
+
+    def set_file_hashes(self, path, size, mtime, sha1, md5):
+        with self._lock:
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (path, size, mtime, sha1, md5))
+
+    def remove(self, blob_id):
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM blobs WHERE blob_id=?", (blob_id,))
+
+    def remove_document(self, document_id):
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM blobs WHERE document_id=?", (document_id,))
+
+    def close(self):
+        self._db.close()
+
+
+# file that marks a directory as a blob cache
+_MARKER = '.chino_blob_cache'
+# names of the files of the blobs, and of the temporary files (see ``temp_file`` and ``add``)
+_KEY = re.compile(r'^[A-Za-z0-9_-]+$')
+_TEMP_NAME = re.compile(r'^(tmp[A-Za-z0-9_]+|[A-Za-z0-9_-]+\.json)\.tmp$')
+
+
+class BlobCache(object):
+    """
+    Blobs downloaded, stored in a directory up to ``max_bytes``. When it is full the least recently used blobs
+    are removed. Each blob is a file named as its id, with the name of the file in ``<blob_id>.json``.
+    Files are written under a temporary name and renamed, so a blob in the cache is always complete; the files
+    left by a process stopped while writing are removed when the cache is opened. Blobs larger than the cache
+    are not kept.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        """
+        :param directory: (str) where the blobs are stored, it is created if missing. An existing directory must be
+            empty or a blob cache, else ``ClientError`` is raised: only the files written by the cache are removed
+        :param max_bytes: (int) max size of the blobs in the cache, default 1GB
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = dict(hits=0, misses=0, evicted=0)
+        self._lock = threading.Lock()
+        # blob_id -> (filename, bytes), the first is the least recently used
+        self._entries = OrderedDict()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = set(os.listdir(directory))
+        if _MARKER not in names:
+            # only the files of the cache are removed, so the directory must be its own
+            if names:
+                raise ClientError("%s is not a blob cache and it is not empty" % directory)
+            open(os.path.join(directory, _MARKER), 'w').close()
+        entries = []
+        for name in names:
+            if _TEMP_NAME.match(name) or (_KEY.match(name) and name + '.json' not in names):
+                # left by a process stopped while writing
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+                continue
+            key = name[:-len('.json')]
+            if not name.endswith('.json') or not _KEY.match(key):
+                continue
+            path = os.path.join(directory, key)
+            try:
+                with open(path + '.json') as rd:
+                    filename = json.load(rd)['filename']
+                entries.append((os.path.getmtime(path), key, filename, os.path.getsize(path)))
+            except (IOError, OSError, ValueError, KeyError):
+                # not complete, it's removed
+                self._remove_files(key)
+        for mtime, key, filename, size in sorted(entries):
+            self._entries[key] = (filename, size)
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def _key(blob_id):
+        # ids are uuid, anything else is hashed so it can't point outside the directory
+        if _KEY.match(blob_id):
+            return blob_id
+        return hashlib.sha1(blob_id.encode('utf-8')).hexdigest()
+
+    def path(self, blob_id):
+        """
+        :return: filename and path of the blob if it is in the cache, else None. The blob becomes the most recently
+            used.
+        """
+        key = self._key(blob_id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries[key] = entry
+            self.stats['hits'] += 1
+        path = os.path.join(self.directory, key)
+        try:
+            # the time of the file keeps the order when the cache is loaded again
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry[0], path
+
+    def open(self, blob_id):
+        """
+        :return: filename and the file of the blob, opened for reading, or None if it is not in the cache
+        """
+        found = self.path(blob_id)
+        if found is None:
+            return None
+        filename, path = found
+        try:
+            return filename, open(path, 'rb')
+        except IOError:
+            # removed by another process
+            self.remove(blob_id)
+            return None
+
+    def temp_file(self):
+        """
+        :return: a file opened for writing in the directory of the cache, to be passed to ``add``
+        """
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        # opened by name, so ``name`` is the path
+        return open(path, 'wb')
+
+    def add(self, blob_id, filename, temp_path):
+        """
+        Moves the file ``temp_path`` (see ``temp_file``) in the cache as the blob ``blob_id``.
+
+        :return: the path of the blob in the cache, None if it is larger than the cache
+        """
+        key = self._key(blob_id)
+        path = os.path.join(self.directory, key)
+        size = os.path.getsize(temp_path)
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            with open(path + '.json.tmp', 'w') as wr:
+                json.dump(dict(filename=filename), wr)
+            _replace(temp_path, path)
+            _replace(path + '.json.tmp', path + '.json')
+            self._entries[key] = (filename, size)
+            self.size += size
+            self._evict()
+        return path
+
+    def add_file(self, blob_id, filename, source_path):
+        """
+        Copies the file ``source_path`` in the cache as the blob ``blob_id``.
+        """
+        with self.temp_file() as wr:
+            with open(source_path, 'rb') as rd:
+                shutil.copyfileobj(rd, wr)
+        return self.add(blob_id, filename, wr.name)
+
+    def remove(self, blob_id):
+        key = self._key(blob_id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self._remove_files(key)
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            key, (filename, size) = self._entries.popitem(last=False)
+            self.size -= size
+            self.stats['evicted'] += 1
+            self._remove_files(key)
+
+    def _remove_files(self, key):
+        for path in (os.path.join(self.directory, key), os.path.join(self.directory, key + '.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class DocumentCache(object):
+    """
+    The last ``size`` documents read, each kept for ``ttl`` seconds. Documents are stored encoded, so changes to the
+    objects returned do not change the cache.
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        """
+        :param size: (int) max number of documents
+        :param ttl: (int) seconds a document is considered fresh
+        """
+        self.size = size
+        self.ttl = ttl
+        self.stats = dict(hits=0, misses=0)
+        self._lock = threading.Lock()
+        # document_id -> (expire time, json), the first is the least recently used
+        self._documents = OrderedDict()
+
+    def get(self, document_id):
+        """
+        :return: (dict) the document as returned by the API, None if it is not in the cache or expired
+        """
+        with self._lock:
+            entry = self._documents.pop(document_id, None)
+            if entry is None or entry[0] < time.time():
+                self.stats['misses'] += 1
+                return None
+            self._documents[document_id] = entry
+            self.stats['hits'] += 1
+        return json.loads(entry[1])
+
+    def put(self, document_id, document):
+        entry = (time.time() + self.ttl, json.dumps(document, separators=(',', ':')))
+        with self._lock:
+            self._documents.pop(document_id, None)
+            self._documents[document_id] = entry
+            while len(self._documents) > self.size:
+                self._documents.popitem(last=False)
+
+    def remove(self, document_id):
+        """
+        :return: (dict) the document removed, also if expired, None if it was not in the cache
+        """
+        with self._lock:
+            entry = self._documents.pop(document_id, None)
+        if entry is None:
+            return None
+        return json.loads(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+
+class CountCache(object):
+    """
+    Results of COUNT searches, by schema and compiled search, each kept for ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.stats = dict(hits=0, misses=0)
+        self._lock = threading.Lock()
+        # schema_id -> key of the search -> (expire time, count)
+        self._counts = dict()
+
+    def get(self, schema_id, key):
+        """
+        :return: (int) the count, None if it is not in the cache or expired
+        """
+        with self._lock:
+            entry = self._counts.get(schema_id, {}).get(key)
+            if entry is None or entry[0] < time.time():
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, schema_id, key, count):
+        with self._lock:
+            self._counts.setdefault(schema_id, {})[key] = (time.time() + self.ttl, count)
+
+    def invalidate(self, schema_id=None):
+        """
+        Drops the counts of ``schema_id``, or of all the schemas if not specified.
+        """
+        with self._lock:
+            if schema_id is None:
+                self._counts.clear()
+            else:
+                self._counts.pop(schema_id, None)
+
+
+class BloomFilter(object):
+    """
+    Set of strings that can answer "maybe in" or "surely not in", using ``-capacity * ln(error_rate) / ln(2)^2``
+    bits. With more than ``capacity`` strings the errors grow.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        # k positions from two hashes (Kirsch-Mitzenmacher)
+        digest = hashlib.md5(key.encode('utf-8') if isinstance(key, unicode) else key).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class UsernameIndex(object):
+    """
+    The usernames of each user schema in a ``BloomFilter``, so a username that is not taken is known without calling
+    the API. The filter of a schema is built reading all its users the first time it is needed, and again after
+    ``ttl`` seconds; users created by the client are added. Users deleted stay in the filter until it is built again:
+    their usernames are checked on the server.
+    """
+
+    def __init__(self, ttl=3600, error_rate=0.01):
+        """
+        :param ttl: (int) seconds after which a filter is built again, to see the users created by other clients
+        :param error_rate: (float) fraction of the usernames not taken that are checked on the server anyway
+        """
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self.stats = dict(local=0, server=0)
+        self._lock = threading.Lock()
+        # user_schema_id -> (expire time, BloomFilter)
+        self._filters = dict()
+
+    def may_exist(self, user_schema_id, username, loader):
+        """
+        :param loader: function returning the number of users of the schema and an iterable of their usernames,
+            called when the filter is missing or expired
+        :return: False if ``username`` is surely not taken, True if it has to be checked on the server
+        """
+        with self._lock:
+            entry = self._filters.get(user_schema_id)
+        if entry is None or entry[0] < time.time():
+            count, usernames = loader()
+            # room for the users that are going to be created before the next build
+            bloom = BloomFilter(max(count * 2, 1000), self.error_rate)
+            for name in usernames:
+                bloom.add(_username_key(name))
+            entry = (time.time() + self.ttl, bloom)
+            with self._lock:
+                self._filters[user_schema_id] = entry
+        found = _username_key(username) in entry[1]
+        self.stats['server' if found else 'local'] += 1
+        return found
+
+    def add(self, username, user_schema_id=None):
+        """
+        Adds a username taken, to the filter of ``user_schema_id`` or to all of them if not specified.
+        """
+        with self._lock:
+            if user_schema_id is None:
+                entries = self._filters.values()
+            else:
+                entries = [self._filters[user_schema_id]] if user_schema_id in self._filters else []
+            for _, bloom in entries:
+                bloom.add(_username_key(username))
+
+    def invalidate(self, user_schema_id=None):
+        with self._lock:
+            if user_schema_id is None:
+                self._filters.clear()
+            else:
+                self._filters.pop(user_schema_id, None)
+
+
+def _username_key(username):
+    # usernames come from the API as unicode, a str is decoded so it is lowered (and hashed) the same way
+    if not isinstance(username, unicode):
+        username = username.decode('utf-8', 'replace')
+    return username.lower()
+
+
+def _replace(src, dst):
+    # on windows rename does not overwrite
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
@@ -29,3 +29,9 @@ class CallFail(CallError):
 class MethodNotSupported(ClientError):
     def __init__(self):
         super(MethodNotSupported, self).__init__("Method not supported")
+
+
+class ValidationError(ClientError):
+    def __init__(self, errors):
+        super(ValidationError, self).__init__(', '.join(errors))
+        self.errors = errors
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+local search over documents held in memory
+~~~~~~~~~~~~~~~~~~~~~
+
+Evaluates the ``filters``, ``sort`` and ``filter_type`` sent to ``searches.documents`` without calling the API.
+Fields can be indexed: equality filters use a dict value -> ids, range filters a sorted list of values.
+
+:copyright: (c) 2015 by Chino SrlS
+:license: Apache 2.0, see LICENSE for more details.
+"""
+import bisect
+import copy
+from collections import OrderedDict
+
+from exceptions import ClientError
+from objects import Document, IDs, ListResult, dict_list_result
+from query import FILTER_TYPES, _filter_parts, _frozen, field_value, sort_key
+
+__author__ = 'Stefano Tranquillini <stefano@chino.io>'
+
+
+def _fold(value, case_sensitive):
+    if not case_sensitive and isinstance(value, basestring):
+        return value.lower()
+    return value
+
+
+def _same(value, expected):
+    # booleans are not numbers: True is not 1, as for the validators
+    return value == expected and isinstance(value, bool) == isinstance(expected, bool)
+
+
+class _BoolKey(tuple):
+    """
+    A boolean in the index of the values, so it is not the same key as 1 or 0
+    """
+
+
+def _index_key(value):
+    if isinstance(value, bool):
+        return _BoolKey((value,))
+    return value
+
+
+def _compare(op, value, expected, case_sensitive):
+    """
+    Compares the value of a field with the one of the filter, arrays match if one of their items does
+    """
+    if isinstance(value, list):
+        return any(_compare(op, item, expected, case_sensitive) for item in value)
+    if value is None:
+        return False
+    value = _fold(value, case_sensitive)
+    if op == 'in':
+        return any(_same(value, _fold(item, case_sensitive)) for item in expected)
+    expected = _fold(expected, case_sensitive)
+    if op == 'eq':
+        return _same(value, expected)
+    if isinstance(value, bool) != isinstance(expected, bool):
+        return False
+    if op == 'lt':
+        return value < expected
+    if op == 'lte':
+        return value <= expected
+    if op == 'gt':
+        return value > expected
+    return value >= expected
+
+
+def matches(document, field, op, value, case_sensitive=False):
+    """
+    :param document: (dict) document as returned by the API
+    :return: True if the document passes the filter
+    """
+    found = field_value(document, field)
+    if op == 'is':
+        if value is None:
+            return found is None
+        return found is value
+    # negations match the documents without the field too
+    if op == 'neq':
+        return not _compare('eq', found, value, case_sensitive)
+    if op == 'nin':
+        return not _compare('in', found, value, case_sensitive)
+    return _compare(op, found, value, case_sensitive)
+
+
+class LocalDocuments(object):
+    """
+    Documents in memory that can be searched as with ``searches.documents``::
+
+        local = LocalDocuments(chino.searches.iter_documents(schema_id, as_dict=True), indexes=['age'])
+        adults = local.search(filters=[dict(field='age', type='gte', value=18)])
+
+    Strings are compared ignoring the case unless the filter has ``case_sensitive``, an array matches if one of
+    its items does, ``neq`` and ``nin`` match also the documents without the field.
+    """
+
+    def __init__(self, documents=(), indexes=()):
+        """
+        :param documents: iterable of ``Document`` or dict
+        :param indexes: list of the fields to index
+        """
+        self._documents = OrderedDict()
+        # field -> folded value -> set of ids
+        self._equal = dict((field, dict()) for field in indexes)
+        # field -> sorted list of (folded value, id), built when needed
+        self._ranges = dict((field, None) for field in indexes)
+        for document in documents:
+            self.add(document)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, document):
+        """
+        Adds a copy of a document, or replaces the one with the same id.
+        """
+        if not isinstance(document, dict):
+            document = document.to_dict()
+        document = copy.deepcopy(document)
+        document_id = document['document_id']
+        if document_id in self._documents:
+            self.remove(document_id)
+        self._documents[document_id] = document
+        for field, values in self._equal.iteritems():
+            for value in self._values(document, field):
+                values.setdefault(value, set()).add(document_id)
+            self._ranges[field] = None
+
+    def remove(self, document_id):
+        document = self._documents.pop(document_id, None)
+        if document is None:
+            return
+        for field, values in self._equal.iteritems():
+            for value in self._values(document, field):
+                ids = values.get(value)
+                if ids is not None:
+                    ids.discard(document_id)
+                    if not ids:
+                        del values[value]
+            self._ranges[field] = None
+
+    def index(self, field):
+        """
+        Indexes ``field`` of the documents already added and of the next ones.
+        """
+        if field in self._equal:
+            return
+        self._equal[field] = dict()
+        self._ranges[field] = None
+        for document_id, document in self._documents.iteritems():
+            for value in self._values(document, field):
+                self._equal[field].setdefault(value, set()).add(document_id)
+
+    @staticmethod
+    def _values(document, field):
+        # strings are indexed in lower case, the filter checks the case when needed
+        value = field_value(document, field)
+        if isinstance(value, list):
+            return set(_index_key(_fold(item, False)) for item in value if item is not None)
+        if value is None:
+            return ()
+        return (_index_key(_fold(value, False)),)
+
+    def _range(self, field):
+        values = self._ranges[field]
+        if values is None:
+            values = sorted((value, document_id) for value, ids in self._equal[field].iteritems()
+                            if not isinstance(value, _BoolKey) for document_id in ids)
+            self._ranges[field] = values
+        return values
+
+    def _candidates(self, field, op, value, case_sensitive):
+        """
+        :return: set of ids that may pass the filter, None if the index can't tell
+        """
+        if field not in self._equal:
+            return None
+        if op == 'eq':
+            return set(self._equal[field].get(_index_key(_fold(value, False)), ()))
+        if op == 'in':
+            ids = set()
+            for item in value:
+                ids.update(self._equal[field].get(_index_key(_fold(item, False)), ()))
+            return ids
+        if op in ('lt', 'lte', 'gt', 'gte') and not (case_sensitive and isinstance(value, basestring)) and \
+                not isinstance(value, bool):
+            values = self._range(field)
+            value = _fold(value, False)
+            if op == 'lt':
+                selected = values[:bisect.bisect_left(values, (value,))]
+            elif op == 'lte':
+                selected = values[:bisect.bisect_right(values, (value, _MAX))]
+            elif op == 'gt':
+                selected = values[bisect.bisect_right(values, (value, _MAX)):]
+            else:
+                selected = values[bisect.bisect_left(values, (value,)):]
+            return set(document_id for _, document_id in selected)
+        return None
+
+    def find(self, filters=None, filter_type="and"):
+        """
+        :return: list of the documents (dict) that pass the filters, in the order they were added. They are copies,
+            changing them does not change the ones held
+        """
+        return copy.deepcopy(self._find(filters, filter_type))
+
+    def _find(self, filters, filter_type):
+        filters = [_filter_parts(_frozen(f)) for f in filters or ()]
+        for field, op, case_sensitive, value in filters:
+            if op not in FILTER_TYPES:
+                raise ClientError("%s: unknown filter type %s" % (field, op))
+        if not filters:
+            return list(self._documents.values())
+        candidates = None
+        if filter_type == "or":
+            candidates = set()
+            for field, op, case_sensitive, value in filters:
+                ids = self._candidates(field, op, value, case_sensitive)
+                if ids is None:
+                    candidates = None
+                    break
+                candidates.update(ids)
+        else:
+            for field, op, case_sensitive, value in filters:
+                ids = self._candidates(field, op, value, case_sensitive)
+                if ids is not None:
+                    candidates = ids if candidates is None else candidates & ids
+        if candidates is None:
+            documents = self._documents.itervalues()
+        else:
+            documents = (document for document_id, document in self._documents.iteritems()
+                         if document_id in candidates)
+        test = any if filter_type == "or" else all
+        return [document for document in documents
+                if test(matches(document, field, op, value, case_sensitive)
+                        for field, op, case_sensitive, value in filters)]
+
+    def search(self, result_type="FULL_CONTENT", filter_type="and", sort=None, filters=None, as_dict=False,
+               offset=0, limit=100):
+        """
+        Searches the documents as ``searches.documents``, the result is the same.
+
+        :return: ``ListResult`` (namedtuple with ``as_dict``) of ``Document`` or ``IDs``, or the count with ``COUNT``
+        """
+        found = self._find(filters, filter_type)
+        if result_type == "COUNT":
+            return len(found)
+        if sort:
+            found.sort(key=sort_key(sort))
+        page = found[offset:offset + limit]
+        if result_type == "ONLY_ID":
+            result = dict(ids=[document['document_id'] for document in page])
+            class_obj = IDs
+        else:
+            if result_type == "NO_CONTENT":
+                page = [dict(document, content=None) for document in page]
+            else:
+                # the results can be changed, the documents held can't
+                page = copy.deepcopy(page)
+            result = dict(documents=page)
+            class_obj = Document
+        result.update(offset=offset, limit=limit, count=len(page), total_count=len(found))
+        if as_dict:
+            return dict_list_result(class_obj, result)
+        return ListResult(class_obj, result)
+
+
+class _Max(object):
+    """
+    Larger than any id, to find the last entry with a value
+    """
+
+    def __gt__(self, other):
+        return True
+
+    def __lt__(self, other):
+        return False
+
+    def __eq__(self, other):
+        return other is self
+
+
+_MAX = _Max()
@@ -1,12 +1,85 @@
 import json
-from collections import namedtuple
+from collections import namedtuple, MutableSequence
+from operator import attrgetter
 
 __author__ = 'Stefano Tranquillini <stefano.tranquillini@gmail.com>'
 import logging
 logger = logging.getLogger('chino')
 
 
+def _slot_names(cls):
+    """
+    Returns the names of all the slots of the class, in order of definition
+    """
+    try:
+        return _SLOT_NAMES[cls]
+    except KeyError:
+        names = []
+        for klass in reversed(cls.__mro__):
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        names = tuple(names)
+        _SLOT_NAMES[cls] = names
+        return names
+
+
+_SLOT_NAMES = dict()
+
+
+def _nested_to_dict(value):
+    if value is None or isinstance(value, dict):
+        return value
+    if isinstance(value, list):
+        return [_nested_to_dict(v) for v in value]
+    return value.to_dict()
+
+
+def _serializer(cls):
+    """
+    Returns the function that converts the objects of ``cls`` into a dict, built once per class.
+    The attributes listed in ``__nested__`` hold objects (or lists of objects) that are converted too.
+    """
+    try:
+        return _SERIALIZERS[cls]
+    except KeyError:
+        pass
+    nested = getattr(cls, '__nested__', ())
+    plain = tuple((name, attrgetter(name)) for name in _slot_names(cls) if name not in nested)
+    deep = tuple((name, attrgetter(name)) for name in _slot_names(cls) if name in nested)
+    # classes without __slots__ (e.g. ListResult) keep their attributes in __dict__
+    has_dict = cls.__dictoffset__ != 0
+
+    def serialize(obj):
+        res = dict()
+        for name, get in plain:
+            try:
+                res[name] = get(obj)
+            except AttributeError:
+                pass
+        for name, get in deep:
+            try:
+                res[name] = _nested_to_dict(get(obj))
+            except AttributeError:
+                pass
+        if has_dict:
+            res.update(obj.__dict__)
+        return res
+
+    _SERIALIZERS[cls] = serialize
+    return serialize
+
+
+_SERIALIZERS = dict()
+
+
 class ChinoBaseObject(object):
+    """
+    Base of the objects. Objects use ``__slots__`` to keep them small, an attribute that is not set is not
+    part of ``to_dict()``. Attributes holding other objects are listed in ``__nested__``.
+    """
+    __slots__ = ()
+    __nested__ = ()
     __str_name__ = 'not set'
     __str_names__ = 'not set'
 
@@ -14,14 +87,17 @@ class ChinoBaseObject(object):
     def _id(self):
         return '-'
 
-    def to_json(self):
-        # raise NotImplementedError()
-        return json.dumps(self, default=lambda o: o.to_dict() if hasattr(o, 'to_dict()') else o.__dict__,
-                          sort_keys=True, indent=4)
+    def to_json(self, compact=False):
+        """
+        :param compact: if True the json has no spaces and keys are not sorted, as sent to the API
+        """
+        if compact:
+            return json.dumps(self.to_dict(), default=_nested_to_dict, separators=(',', ':'))
+        return json.dumps(self.to_dict(), default=_nested_to_dict, sort_keys=True, indent=4)
 
     def to_dict(self):
         # make a copy here
-        return dict(self.__dict__)
+        return _serializer(type(self))(self)
 
     def __str__(self):
         # return str(self.to_dict())
@@ -31,8 +107,25 @@ class ChinoBaseObject(object):
         # return str(self.to_dict())
         return "<%s:%s>" % (self.__str_name__.upper(), self._id)
 
+    def __getstate__(self):
+        # objects with __slots__ have no __dict__, pickle gets the attributes that are set from here
+        state = dict()
+        for name in _slot_names(type(self)):
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        if type(self).__dictoffset__ != 0:
+            state.update(self.__dict__)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
 
 class Paging(ChinoBaseObject):
+    __slots__ = ('offset', 'limit', 'total_count', 'count')
 
     def __init__(self, offset=0, limit=100, count=-1, total_count=-1):
         super(Paging, self).__init__()
@@ -51,32 +144,111 @@ class Paging(ChinoBaseObject):
         return "Paging [offset:%s,limit:%s,count:%s,total_count:%s]" % (self.offset, self.limit, self.count, self.total_count)
 
 
+class _LazyList(MutableSequence):
+    """
+    List of objects that keeps the items as they come from the API and builds each object only the first
+    time it is accessed. Built objects are cached.
+    """
+
+    def __init__(self, class_obj, items):
+        self._class_obj = class_obj
+        self._items = items
+        self._objects = [None] * len(items)
+
+    def _build(self, index):
+        obj = self._objects[index]
+        if obj is None:
+            r = self._items[index]
+            if type(r) == dict:
+                obj = self._class_obj(**r)
+            else:
+                obj = self._class_obj(r)
+            self._objects[index] = obj
+        return obj
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._build(i) for i in xrange(*index.indices(len(self._items)))]
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError('list index out of range')
+        return self._build(index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+        self._items[index] = value
+        self._objects[index] = value
+
+    def __delitem__(self, index):
+        del self._items[index]
+        del self._objects[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        for i in xrange(len(self._items)):
+            yield self._build(i)
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+        self._objects.insert(index, value)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class ListResult(ChinoBaseObject):
+    """
+    A page of results: ``paging`` and the list of objects in the attribute named as the objects (e.g.
+    ``documents``). The objects are built when accessed.
+    """
 
     def __init__(self, class_obj, result):
         self.paging = Paging(result['offset'], result['limit'], result[
                              'count'], result['total_count'])
-        results = []
-        for r in result[class_obj.__str_names__]:
-            if type(r) == dict:
-                results.append(class_obj(**r))
-            else:
-                results.append(class_obj(r))
-        self.__setattr__(class_obj.__str_names__, results)
+        self.__setattr__(class_obj.__str_names__, _LazyList(class_obj, result[class_obj.__str_names__]))
         self.class_obj = class_obj.__str_names__
 
     def to_dict(self):
-        res = super(ListResult, self).to_dict()
-        res['paging'] = self.paging.to_dict()
-        res[self.class_obj] = [o.to_dict()
-                               for o in self.__getattribute__(self.class_obj)]
-        del res['class_obj']
-        return res
+        return {
+            'paging': self.paging.to_dict(),
+            self.class_obj: [o.to_dict() for o in self.__getattribute__(self.class_obj)]
+        }
+
+
+PagingTuple = namedtuple('PagingTuple', ['offset', 'limit', 'count', 'total_count'])
+
+_DICT_LIST_RESULTS = dict()
+
+
+def dict_list_result(class_obj, result):
+    """
+    Lightweight version of ``ListResult``: a namedtuple with ``paging`` (a ``PagingTuple``) and the list of
+    items as they come from the API, e.g. ``res.documents`` is a list of dict.
+    """
+    name = class_obj.__str_names__
+    try:
+        tuple_class = _DICT_LIST_RESULTS[name]
+    except KeyError:
+        tuple_class = namedtuple('%sResult' % name.title().replace('_', ''), ['paging', name])
+        _DICT_LIST_RESULTS[name] = tuple_class
+    return tuple_class(PagingTuple(result['offset'], result['limit'], result['count'], result['total_count']),
+                       result[name])
 
 
 class _DictContent(ChinoBaseObject):
     """
-    Subclass for the content that is a dict.
+    Subclass for the content that is a dict. The dict is kept as it is and the keys are read and written as
+    attributes.
 
     Example::
 
@@ -88,9 +260,38 @@ class _DictContent(ChinoBaseObject):
         }
     """
 
+    __slots__ = ('_content',)
+
     def __init__(self, *args, **kwargs):
-        for k, v in kwargs.iteritems():
-            self.__setattr__(k, v)
+        # _DictContent(content) keeps the dict, _DictContent(**content) uses a copy. The objects own their content:
+        # Document, User and Group pass a copy, so changing them does not change the dict they were built from
+        if args:
+            object.__setattr__(self, '_content', args[0])
+        else:
+            object.__setattr__(self, '_content', kwargs)
+
+    def __getattr__(self, name):
+        if name == '_content':
+            raise AttributeError(name)
+        try:
+            return self._content[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name == '_content':
+            object.__setattr__(self, name, value)
+        else:
+            self._content[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self._content[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_dict(self):
+        return dict(self._content)
 
     @property
     def _id(self):
@@ -98,6 +299,7 @@ class _DictContent(ChinoBaseObject):
 
 
 class IDs(ChinoBaseObject):
+    __slots__ = ('id',)
     __str_name__ = 'id'
     __str_names__ = 'ids'
 
@@ -124,6 +326,7 @@ class Repository(ChinoBaseObject):
             }
 
     """
+    __slots__ = ('repository_id', 'description', 'insert_date', 'last_update', 'is_active')
     __str_name__ = 'repository'
     __str_names__ = 'repositories'
 
@@ -163,6 +366,9 @@ class User(ChinoBaseObject):
 
     For the creation it has `password`
     """
+    __slots__ = ('username', 'user_id', 'insert_date', 'last_update', 'schema_id', 'is_active', 'attributes', 'groups',
+                 'password')
+    __nested__ = ('attributes',)
     __str_name__ = 'user'
     __str_names__ = 'users'
 
@@ -170,15 +376,6 @@ class User(ChinoBaseObject):
     def _id(self):
         return self.user_id
 
-    def to_dict(self):
-        res = super(User, self).to_dict()
-        if hasattr(res, 'password'):
-            del res['password']
-        if self.attributes:
-            if type(self.attributes) is not dict:
-                res['attributes'] = self.attributes.to_dict()
-        return res
-
     def __init__(self, user_id=None, username=None, insert_date=None, schema_id=None, last_update=None, is_active=None,
                  attributes=None,
                  groups=None, password=None):
@@ -188,7 +385,7 @@ class User(ChinoBaseObject):
         self.last_update = last_update
         self.schema_id = schema_id
         self.is_active = is_active
-        self.attributes = _DictContent(**attributes) if attributes else None
+        self.attributes = _DictContent(dict(attributes)) if attributes else None
         self.groups = groups
         self.password = password
 
@@ -213,6 +410,8 @@ class Group(ChinoBaseObject):
 
     """
 
+    __slots__ = ('group_id', 'group_name', 'insert_date', 'last_update', 'is_active', 'attributes')
+    __nested__ = ('attributes',)
     __str_name__ = 'group'
     __str_names__ = 'groups'
 
@@ -220,13 +419,6 @@ class Group(ChinoBaseObject):
     def _id(self):
         return self.group_id
 
-    def to_dict(self):
-        res = super(Group, self).to_dict()
-        if self.attributes:
-            if type(self.attributes) is not dict:
-                res['attributes'] = self.attributes.to_dict()
-        return res
-
     def __init__(self, group_id=None, group_name=None, insert_date=None, is_active=None, last_update=None,
                  attributes=None):
         """Constructor for Group"""
@@ -235,7 +427,7 @@ class Group(ChinoBaseObject):
         self.insert_date = insert_date
         self.last_update = last_update
         self.is_active = is_active
-        self.attributes = _DictContent(**attributes) if attributes else None
+        self.attributes = _DictContent(dict(attributes)) if attributes else None
 
 
 class Document(ChinoBaseObject):
@@ -259,6 +451,8 @@ class Document(ChinoBaseObject):
           }
         }
     """
+    __slots__ = ('document_id', 'repository_id', 'schema_id', 'insert_date', 'last_update', 'is_active', 'content')
+    __nested__ = ('content',)
     __str_name__ = 'document'
     __str_names__ = 'documents'
 
@@ -266,12 +460,6 @@ class Document(ChinoBaseObject):
     def _id(self):
         return self.document_id
 
-    def to_dict(self):
-        res = super(Document, self).to_dict()
-        if self.content:
-            res['content'] = self.content.to_dict()
-        return res
-
     def __init__(self, document_id=None, repository_id=None, schema_id=None, insert_date=None, last_update=True,
                  content=None, is_active=False):
         self.document_id = document_id
@@ -280,10 +468,11 @@ class Document(ChinoBaseObject):
         self.insert_date = insert_date
         self.last_update = last_update
         self.is_active = is_active
-        self.content = _DictContent(**content) if content else None
+        self.content = _DictContent(dict(content)) if content else None
 
 
 class _Field(ChinoBaseObject):
+    __slots__ = ('type', 'name', 'indexed')
 
     def __init__(self, type, name, indexed=None):
         self.type = type
@@ -300,6 +489,8 @@ class _Field(ChinoBaseObject):
 
 
 class _Fields(ChinoBaseObject):
+    __slots__ = ('fields',)
+    __nested__ = ('fields',)
 
     def __init__(self, fields):
         self.fields = fields
@@ -352,21 +543,11 @@ class Schema(ChinoBaseObject):
             }
     """
 
+    __slots__ = ('schema_id', 'description', 'repository_id', 'is_active', 'insert_date', 'last_update', 'structure')
+    __nested__ = ('structure',)
     __str_name__ = 'schema'
     __str_names__ = 'schemas'
 
-    def to_dict(self):
-        res = super(Schema, self).to_dict()
-        res['structure'] = dict(fields=[f.to_dict()
-                                        for f in self.structure.fields])
-        return res
-
-    # # print res
-    #     if self.structure:
-    #         if type(self.structure) is not dict:
-    #             res['structure'] = dict(fields=[f.to_dict() for f in self.structure.fields])
-    #     return res
-
     @property
     def _id(self):
         return self.schema_id
@@ -389,15 +570,11 @@ class UserSchema(ChinoBaseObject):
     """
     Similar to Schema
     """
+    __slots__ = ('user_schema_id', 'description', 'groups', 'is_active', 'insert_date', 'last_update', 'structure')
+    __nested__ = ('structure',)
     __str_name__ = 'user_schema'
     __str_names__ = 'user_schemas'
 
-    def to_dict(self):
-        res = super(UserSchema, self).to_dict()
-        res['structure'] = dict(fields=[f.to_dict()
-                                        for f in self.structure.fields])
-        return res
-
     @property
     def _id(self):
         return self.user_schema_id
@@ -431,6 +608,7 @@ class Collection(ChinoBaseObject):
               "insert_date": "2016-02-08T11:05:26.571Z"
             }
     """
+    __slots__ = ('collection_id', 'name', 'insert_date', 'last_update', 'is_active')
     __str_name__ = 'collection'
     __str_names__ = 'collections'
 
@@ -460,6 +638,7 @@ class Application(ChinoBaseObject):
             "app_id": "4ke1mor5GW4YtH80Y9eIaAFLHUAwLtQ1l7wOQnQV"
           },
     """
+    __slots__ = ('app_name', 'app_secret', 'app_id', 'redirect_url', 'grant_type')
     __str_name__ = 'application'
     __str_names__ = 'applications'
 
@@ -509,6 +688,8 @@ class Permission(ChinoBaseObject):
            "result_code":200
         }
     """
+    __slots__ = ('access', 'permission', 'resource_type', 'resource_id', 'parent_id')
+    __nested__ = ('permission',)
     __str_name__ = 'permission'
     __str_names__ = 'permissions'
 
@@ -527,13 +708,10 @@ class Permission(ChinoBaseObject):
             # TODO: can parent_id be None?
             self.parent_id = parent_id
 
-    def to_dict(self):
-        res = super(Permission, self).to_dict()
-        res['permission'] = self.permission.to_dict()
-        return res
 
 
 class _PermissionField(ChinoBaseObject):
+    __slots__ = ('authorize', 'manage', 'created_document')
 
     def __init__(self, Authorize=None, Manage=None, created_document=None):
         if Authorize:
@@ -549,18 +727,9 @@ class _PermissionField(ChinoBaseObject):
     def _id(self):
         return "-"
 
-    def to_dict(self):
-        res = dict()
-        if hasattr(self, 'authorize'):
-            res['authorize'] = self.authorize
-        if hasattr(self, 'manage'):
-            res['manage'] = self.manage
-        if hasattr(self, 'created_document'):
-            res['created_document'] = self.created_document
-        return res
-
 
 class _SortField(ChinoBaseObject):
+    __slots__ = ('field', 'order')
 
     def __init__(self, field, order='asc'):
         self.field = field
@@ -572,6 +741,7 @@ class _SortField(ChinoBaseObject):
 
 
 class _FilterField(ChinoBaseObject):
+    __slots__ = ('field', 'type', 'case_sensitive', 'value')
 
     def __init__(self, field, value, type='eq', case_sensitive=False):
         self.field = field
@@ -585,6 +755,8 @@ class _FilterField(ChinoBaseObject):
 
 
 class Search(ChinoBaseObject):
+    __slots__ = ('schema_id', 'result_type', 'sort', 'filters')
+    __nested__ = ('sort', 'filters')
 
     def __init__(self, schema_id, result_type, sort=None, filters=None):
         self.schema_id = schema_id
@@ -602,15 +774,8 @@ class Search(ChinoBaseObject):
                 if type(f) is dict:
                     self.filters.append(_FilterField(**f))
                 else:
-                    self.sort.append(f)
+                    self.filters.append(f)
 
-    def to_dict(self):
-        res = super(Search, self).to_dict()
-        if self.sort:
-            res['sort'] = [s.to_dict() for s in self.sort]
-        if self.filters:
-            res['filters'] = [f.to_dict() for f in self.filters]
-        return res
 
 
 _PermissionProperty = namedtuple(
@@ -716,3 +881,4 @@ _PermissionProperty = namedtuple(
 Blob = namedtuple('Blob', ['filename', 'content'])
 BlobDetail = namedtuple(
     'BlobDetail', ['bytes', 'blob_id', 'sha1', 'document_id', 'md5'])
+BlobDownload = namedtuple('BlobDownload', ['filename', 'bytes', 'sha1', 'md5'])
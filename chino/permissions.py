@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+local index of the permissions
+~~~~~~~~~~~~~~~~~~~~~
+
+The permissions read with ``read_perms*`` are compiled into a set of keys
+(resource type, resource, action) for each subject, so a check is a few lookups.
+
+:copyright: (c) 2015 by Chino SrlS
+:license: Apache 2.0, see LICENSE for more details.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from objects import Permission
+
+__author__ = 'Stefano Tranquillini <stefano@chino.io>'
+
+# the subject of ``read_perms``: the user (or customer) calling the API
+CALLER = ('caller', None)
+
+_RESOURCE_TYPES = {
+    'repository': 'repositories',
+    'schema': 'schemas',
+    'document': 'documents',
+    'user_schema': 'user_schemas',
+    'userschema': 'user_schemas',
+    'user': 'users',
+    'group': 'groups',
+    'collection': 'collections',
+}
+
+_ACTIONS = {
+    'create': 'C',
+    'read': 'R',
+    'update': 'U',
+    'delete': 'D',
+    'list': 'L',
+    'authorize': 'A',
+}
+
+
+def resource_type_key(resource_type):
+    """
+    :return: the resource type as in the urls, e.g. ``Schema`` and ``schema`` are ``schemas``
+    """
+    resource_type = resource_type.lower().replace(' ', '_')
+    return _RESOURCE_TYPES.get(resource_type, resource_type)
+
+
+def action_key(action):
+    """
+    :return: the letter of the action, e.g. ``read`` is ``R``
+    """
+    return _ACTIONS.get(action.lower(), action.upper())
+
+
+# type of the parent of the children, for ``resource_children``
+_PARENT_TYPES = {
+    'documents': 'schemas',
+    'schemas': 'repositories',
+    'users': 'user_schemas',
+}
+
+_ORDER = 'CRUDLA'
+
+PermissionChange = namedtuple('PermissionChange', ['action', 'resource_type', 'resource_id', 'resource_child_type',
+                                                   'subject_type', 'subject_id', 'manage', 'authorize'])
+
+
+def subject_key(subject_type, subject_id):
+    if subject_type is None:
+        return CALLER
+    return resource_type_key(subject_type), subject_id
+
+
+def _resource(resource_id=None, parent_id=None):
+    # the children of a resource are a resource of their own
+    if resource_id is None and parent_id is not None:
+        return 'children', parent_id
+    return resource_id
+
+
+def compile_permissions(permissions):
+    """
+    :param permissions: list of ``Permission`` or dict
+    :return: set of keys (kind, resource type, resource, action), kind is 'manage' or 'authorize',
+        resource is None for the permissions on all the resources of the type
+    """
+    keys = set()
+    for perm in permissions:
+        if type(perm) is dict:
+            perm = Permission(**perm)
+        field = getattr(perm, 'permission', None)
+        if field is None:
+            continue
+        resource_type = resource_type_key(perm.resource_type or '')
+        resource = _resource(getattr(perm, 'resource_id', None), getattr(perm, 'parent_id', None))
+        for kind in ('manage', 'authorize'):
+            for action in getattr(field, kind, None) or ():
+                keys.add((kind, resource_type, resource, action_key(action)))
+    return keys
+
+
+def desired_keys(grants):
+    """
+    :param grants: list of dict with ``resource_type``, ``resource_id`` (optional, for all the resources of the type
+        if missing), ``resource_child_type`` (optional, for the children of the resource), ``manage`` and
+        ``authorize`` lists of actions
+    :return: set of keys, see ``compile_permissions``
+    """
+    keys = set()
+    for grant in grants:
+        resource_type = resource_type_key(grant['resource_type'])
+        resource = grant.get('resource_id')
+        if grant.get('resource_child_type'):
+            resource_type = resource_type_key(grant['resource_child_type'])
+            resource = _resource(parent_id=resource)
+        for kind in ('manage', 'authorize'):
+            for action in grant.get(kind) or ():
+                keys.add((kind, resource_type, resource, action_key(action)))
+    return keys
+
+
+def diff_permissions(subject, current, desired, prune=False):
+    """
+    Computes the calls that change the ``current`` permissions of ``subject`` into the ``desired`` ones.
+    The actions on the same resource are sent with one call.
+
+    :param subject: (subject_type, subject_id)
+    :param current: set of keys, see ``compile_permissions``
+    :param desired: set of keys
+    :param prune: (bool) if True the permissions not desired are revoked, else they are kept
+    :return: list of ``PermissionChange``
+    """
+    changes = []
+    groups = [('grant', desired - current)]
+    if prune:
+        groups.append(('revoke', current - desired))
+    for action, keys in groups:
+        calls = dict()
+        for kind, resource_type, resource, letter in keys:
+            calls.setdefault((resource_type, resource), dict(manage=set(), authorize=set()))[kind].add(letter)
+        for (resource_type, resource), letters in sorted(calls.items()):
+            child_type = None
+            if isinstance(resource, tuple):
+                child_type = resource_type
+                resource_type = _PARENT_TYPES.get(resource_type, resource_type)
+                resource = resource[1]
+            manage, authorize = [sorted(letters[kind], key=lambda letter: _ORDER.find(letter)) or None
+                                 for kind in ('manage', 'authorize')]
+            changes.append(PermissionChange(action, resource_type, resource, child_type, subject[0], subject[1],
+                                            manage, authorize))
+    return changes
+
+
+class PermissionIndex(object):
+    """
+    The permissions of users, groups and of the caller, each set kept for ``ttl`` seconds.
+    Grants and revokes done by the client drop the set of the subject.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.stats = dict(hits=0, loads=0)
+        self._lock = threading.Lock()
+        # subject -> (expire time, set of keys)
+        self._subjects = dict()
+
+    def set(self, subject, permissions):
+        """
+        :param subject: (subject_type, subject_id), e.g. ('users', id), or ``CALLER``
+        :param permissions: list of ``Permission`` of the subject
+        """
+        keys = compile_permissions(permissions)
+        with self._lock:
+            self._subjects[subject] = (time.time() + self.ttl, keys)
+        return keys
+
+    def add(self, subject, permissions):
+        """
+        Adds permissions to the ones of the subject, e.g. read with ``read_perms_document``. They are added only if
+        the permissions of the subject are in the index, else they would be taken as all its permissions.
+        """
+        keys = compile_permissions(permissions)
+        with self._lock:
+            entry = self._subjects.get(subject)
+            if entry is not None and entry[0] >= time.time():
+                entry[1].update(keys)
+
+    def keys(self, subject, loader=None):
+        """
+        :param loader: function returning the permissions of the subject, called if they are missing or expired
+        :return: set of keys, see ``compile_permissions``
+        """
+        with self._lock:
+            entry = self._subjects.get(subject)
+        if entry is not None and entry[0] >= time.time():
+            self.stats['hits'] += 1
+            return entry[1]
+        if loader is None:
+            return set()
+        self.stats['loads'] += 1
+        return self.set(subject, loader())
+
+    def can(self, subject, action, resource_type, resource_id=None, parent_id=None, authorize=False, loader=None,
+            groups=(), group_loader=None):
+        """
+        :param subject: (subject_type, subject_id) or ``CALLER``
+        :param action: (str) ``R``, ``read``, ...
+        :param resource_id: (id) of the resource, None for the permission on all the resources of the type
+        :param parent_id: (id) of the parent (e.g. the schema of a document), the permissions on its children count
+        :param authorize: (bool) if True checks if the subject can grant the action, else if it can do it
+        :param groups: list of (id) of the groups of a user, their permissions count
+        :param group_loader: function taking a group id and returning its permissions
+        :return: (bool)
+        """
+        kind = 'authorize' if authorize else 'manage'
+        resource_type = resource_type_key(resource_type)
+        action = action_key(action)
+        wanted = [(kind, resource_type, None, action)]
+        if resource_id is not None:
+            wanted.append((kind, resource_type, resource_id, action))
+        if parent_id is not None:
+            wanted.append((kind, resource_type, _resource(parent_id=parent_id), action))
+        subjects = [(subject, loader)]
+        for group_id in groups:
+            subjects.append((('groups', group_id), group_loader and (lambda group_id=group_id: group_loader(group_id))))
+        for key, load in subjects:
+            keys = self.keys(key, load)
+            for item in wanted:
+                if item in keys:
+                    return True
+        return False
+
+    def invalidate(self, subject=None):
+        """
+        Drops the permissions of ``subject``, or of all the subjects if not specified.
+        """
+        with self._lock:
+            if subject is None:
+                self._subjects.clear()
+            else:
+                self._subjects.pop(subject, None)
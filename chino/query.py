@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+query builder for the search API
+~~~~~~~~~~~~~~~~~~~~~
+
+A query is checked against the fields of the schema and encoded once (``Plan``),
+then it can be run many times changing only offset and limit, that are sent as parameters.
+
+:copyright: (c) 2015 by Chino SrlS
+:license: Apache 2.0, see LICENSE for more details.
+"""
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from exceptions import ValidationError
+from objects import _FilterField, _SortField, Search
+from validators import _CHECKS, _is_any, _field_pair
+
+__author__ = 'Stefano Tranquillini <stefano@chino.io>'
+
+FILTER_TYPES = ('eq', 'neq', 'lt', 'lte', 'gt', 'gte', 'is', 'in', 'nin')
+SORT_ORDERS = ('asc', 'desc')
+# fields that can be used to search users, but are not in the user schema
+_USER_FIELDS = dict(username=dict(name='username', type='string', indexed=True))
+# fields of the documents, not in the schema
+_DOCUMENT_FIELDS = dict(insert_date=dict(name='insert_date', type='datetime', indexed=True),
+                        last_update=dict(name='last_update', type='datetime', indexed=True))
+
+
+class _FrozenDict(tuple):
+    """
+    Items of a dict, so it can be in a key
+    """
+
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return _FrozenDict(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, _FrozenDict):
+        return dict((key, _thaw(item)) for key, item in value)
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+def _frozen(item):
+    """
+    :return: a filter or sort (dict or object) frozen with the keys as given, so it can be in a key and it is
+        sent as it is
+    """
+    if type(item) is not dict:
+        item = item.to_dict()
+    return _freeze(item)
+
+
+def _filter_parts(f):
+    """
+    :param f: a filter frozen by ``_frozen``
+    :return: (field, type, case_sensitive, value), None for the keys missing
+    """
+    f = dict(f)
+    return f.get('field'), f.get('type'), bool(f.get('case_sensitive')), f.get('value')
+
+
+def _sort_parts(s):
+    """
+    :param s: a sort frozen by ``_frozen``
+    :return: (field, order), the order is ascending if missing
+    """
+    s = dict(s)
+    return s.get('field'), s.get('order', 'asc')
+
+
+def query_key(kind, schema_id, result_type, filter_type, sort, filters):
+    """
+    :return: a hashable key of the search, the same for equal filters and sort given as dicts or objects
+    """
+    return (kind, schema_id, result_type, filter_type,
+            tuple(_frozen(s) for s in sort or ()),
+            tuple(_frozen(f) for f in filters or ()))
+
+
+def check_query(kind, filters, sort, fields):
+    """
+    Checks that the filters and sort use fields of the schema that are indexed, with values of their type.
+
+    :param kind: 'documents' or 'users'
+    :param filters: list of filters frozen by ``_frozen``
+    :param sort: list of sort frozen by ``_frozen``
+    :param fields: dict name -> field of the schema
+    :raise ValidationError: with all the errors found
+    """
+    if kind == 'users':
+        fields = dict(fields, **_USER_FIELDS)
+    else:
+        fields = dict(fields, **_DOCUMENT_FIELDS)
+    errors = []
+
+    def field_type(name):
+        field = fields.get(name)
+        if field is None:
+            errors.append("%s: field not in the schema" % name)
+            return None
+        indexed = field.get('indexed', True) if type(field) is dict else getattr(field, 'indexed', True)
+        if indexed is False:
+            errors.append("%s: field is not indexed" % name)
+            return None
+        return _field_pair(field)[1]
+
+    for name, filter_type, case_sensitive, value in (_filter_parts(f) for f in filters):
+        if filter_type not in FILTER_TYPES:
+            errors.append("%s: unknown filter type %s" % (name, filter_type))
+            continue
+        ftype = field_type(name)
+        if ftype is None:
+            continue
+        if filter_type == 'is':
+            if value is not None and not isinstance(value, bool):
+                errors.append("%s: 'is' expects null or a boolean, got %r" % (name, value))
+            continue
+        # arrays are searched by their items
+        check = _CHECKS.get(ftype[len('array['):-1] if ftype.startswith('array[') else ftype, _is_any)
+        values = value if filter_type in ('in', 'nin') else (value,)
+        if not isinstance(values, tuple):
+            errors.append("%s: '%s' expects a list, got %r" % (name, filter_type, value))
+            continue
+        for item in values:
+            if not check(item):
+                errors.append("%s: expected %s, got %r" % (name, ftype, item))
+    for name, order in (_sort_parts(s) for s in sort):
+        if order not in SORT_ORDERS:
+            errors.append("%s: unknown sort order %s" % (name, order))
+        field_type(name)
+    if errors:
+        raise ValidationError(errors)
+
+
+def split_range(low, high, partitions):
+    """
+    :return: the ``partitions`` - 1 values that split [low, high] in ranges of the same width, integers if low and
+        high are integers, strings in the same format if they are dates or datetimes (e.g. ``insert_date``)
+    :raise ValueError: if low and high are not numbers nor dates
+    """
+    if isinstance(low, basestring) and isinstance(high, basestring):
+        return _split_dates(low, high, partitions)
+    if not isinstance(low, (int, long, float)) or not isinstance(high, (int, long, float)):
+        raise ValueError("%r and %r are not numbers" % (low, high))
+    step = (high - low) / float(partitions)
+    bounds = []
+    for i in xrange(1, partitions):
+        bound = low + step * i
+        if isinstance(low, (int, long)) and isinstance(high, (int, long)):
+            bound = int(bound)
+        if bound > low and (not bounds or bound > bounds[-1]):
+            bounds.append(bound)
+    return bounds
+
+
+# formats of the dates sent by the API, the milliseconds have 3 digits
+_DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+def _parse_date(value):
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format), date_format
+        except ValueError:
+            pass
+    raise ValueError("%r is not a date" % value)
+
+
+def _split_dates(low, high, partitions):
+    start, date_format = _parse_date(low)
+    end = _parse_date(high)[0]
+    bounds = []
+    for seconds in split_range(0.0, (end - start).total_seconds(), partitions):
+        bound = (start + timedelta(seconds=seconds)).strftime(date_format)
+        if date_format.endswith('%f'):
+            bound = bound[:-3]
+        if bound > low and (not bounds or bound > bounds[-1]):
+            bounds.append(bound)
+    return bounds
+
+
+def range_filters(field, bounds):
+    """
+    :param bounds: sorted values splitting the ranges
+    :return: list with the filters of each range: < bounds[0], >= bounds[0] and < bounds[1], ..., >= bounds[-1]
+    """
+    lows = [None] + list(bounds)
+    highs = list(bounds) + [None]
+    result = []
+    for low, high in zip(lows, highs):
+        filters = []
+        if low is not None:
+            filters.append(dict(field=field, type='gte', value=low))
+        if high is not None:
+            filters.append(dict(field=field, type='lt', value=high))
+        result.append(filters)
+    return result
+
+
+class _Descending(object):
+    """
+    Wraps a value inverting the order
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def field_value(document, field):
+    """
+    :param document: (dict) document as returned by the API
+    :return: the value of ``field`` in the content, or of the document (e.g. ``insert_date``)
+    """
+    content = document.get('content') or {}
+    if field in content:
+        return content[field]
+    return document.get(field)
+
+
+def sort_key(sort):
+    """
+    :param sort: list of dict or ``_SortField``
+    :return: function that takes a document (dict) and returns the key to sort it as the API does
+    """
+    orders = [_sort_parts(_frozen(s)) for s in sort]
+
+    def key(document):
+        return tuple(field_value(document, field) if order == 'asc' else _Descending(field_value(document, field))
+                     for field, order in orders)
+
+    return key
+
+
+class Plan(object):
+    """
+    A compiled search: the url and the encoded body, ready to be sent.
+    """
+    __slots__ = ('kind', 'schema_id', 'result_type', 'url', 'body')
+
+    def __init__(self, kind, schema_id, result_type, filter_type, sort, filters):
+        """
+        :param sort: list of sort frozen by ``_frozen``
+        :param filters: list of filters frozen by ``_frozen``
+        """
+        self.kind = kind
+        self.schema_id = schema_id
+        self.result_type = result_type
+        self.url = 'search/%s/%s' % (kind, schema_id)
+        data = dict(result_type=result_type, filter_type=filter_type, filter=[_thaw(f) for f in filters])
+        if sort:
+            data['sort'] = [_thaw(s) for s in sort]
+        self.body = json.dumps(data, separators=(',', ':'))
+
+
+class PlanCache(object):
+    """
+    The last ``size`` plans compiled, by ``query_key``.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compile_plan):
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            if plan is not None:
+                self._plans[key] = plan
+                return plan
+        plan = compile_plan()
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def invalidate(self, schema_id=None):
+        with self._lock:
+            if schema_id is None:
+                self._plans.clear()
+            else:
+                for key in [key for key in self._plans if key[1] == schema_id]:
+                    del self._plans[key]
+
+
+class Query(object):
+    """
+    Builds a search on a schema (``searches.query``) or user schema (``searches.query_users``)::
+
+        query = chino.searches.query(schema_id).filter('age', 'gt', 18).sort('age', 'desc')
+        first = query.run(limit=10)
+        second = query.run(offset=10, limit=10)
+
+    The query is compiled the first time it runs, then the same body is sent.
+    """
+
+    def __init__(self, searches, kind, schema_id, result_type='FULL_CONTENT', filter_type='and'):
+        self._searches = searches
+        self.kind = kind
+        self.schema_id = schema_id
+        self.result_type = result_type
+        self.filter_type = filter_type
+        self.filters = []
+        self.sorts = []
+        self._plan = None
+
+    @classmethod
+    def from_search(cls, searches, search, kind='documents', filter_type='and'):
+        """
+        :param search: (Search) object with schema_id, result_type, sort and filters
+        """
+        query = cls(searches, kind, search.schema_id, search.result_type, filter_type)
+        for f in search.filters:
+            query.filter(f.field, f.type, f.value, f.case_sensitive)
+        for s in search.sort:
+            query.sort(s.field, s.order)
+        return query
+
+    def filter(self, field, type, value, case_sensitive=False):
+        self.filters.append(_FilterField(field, value, type, case_sensitive))
+        self._plan = None
+        return self
+
+    def sort(self, field, order='asc'):
+        self.sorts.append(_SortField(field, order))
+        self._plan = None
+        return self
+
+    def to_search(self):
+        return Search(self.schema_id, self.result_type, sort=list(self.sorts), filters=list(self.filters))
+
+    def compile(self):
+        """
+        :return: (Plan) the query checked against the schema and encoded
+        """
+        if self._plan is None:
+            self._plan = self._searches.plan(self.kind, self.schema_id, self.result_type, self.filter_type,
+                                             self.sorts, self.filters, check=True)
+        return self._plan
+
+    def run(self, as_dict=None, **params):
+        """
+        :param params: parameters of the call, e.g. ``offset`` and ``limit``
+        :return: the result of the search, as ``searches.documents`` or ``searches.users``
+        """
+        return self._searches.run(self.compile(), as_dict, **params)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+client side validation of document contents and user attributes
+~~~~~~~~~~~~~~~~~~~~~
+
+The fields of a schema are compiled once into a dict of checks, one per field,
+so validating a content is a lookup and a call for each key.
+
+:copyright: (c) 2015 by Chino SrlS
+:license: Apache 2.0, see LICENSE for more details.
+"""
+import re
+
+from exceptions import ValidationError
+
+__author__ = 'Stefano Tranquillini <stefano@chino.io>'
+
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_TIME = re.compile(r'^\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?$')
+_DATETIME = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?(Z|[+-]\d{2}:?\d{2})?$')
+_BASE64 = re.compile(r'^[A-Za-z0-9+/\r\n]*={0,2}$')
+
+
+def _is_any(value):
+    return True
+
+
+def _is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def _is_float(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _is_string(value):
+    return isinstance(value, basestring)
+
+
+def _is_boolean(value):
+    return isinstance(value, bool)
+
+
+def _is_json(value):
+    return isinstance(value, (dict, list))
+
+
+def _matches(regex):
+    match = regex.match
+
+    def check(value):
+        return isinstance(value, basestring) and match(value) is not None
+
+    return check
+
+
+def _array_of(item_check):
+    def check(value):
+        if not isinstance(value, list):
+            return False
+        for item in value:
+            if not item_check(item):
+                return False
+        return True
+
+    return check
+
+
+_CHECKS = {
+    'integer': _is_integer,
+    'float': _is_float,
+    'string': _is_string,
+    'text': _is_string,
+    'boolean': _is_boolean,
+    'date': _matches(_DATE),
+    'time': _matches(_TIME),
+    'datetime': _matches(_DATETIME),
+    'base64': _matches(_BASE64),
+    'json': _is_json,
+    'blob': _is_any,
+    'array[integer]': _array_of(_is_integer),
+    'array[float]': _array_of(_is_float),
+    'array[string]': _array_of(_is_string),
+}
+
+
+def _field_pair(field):
+    if type(field) is dict:
+        return field['name'], field['type']
+    return field.name, field.type
+
+
+def compile_validator(fields):
+    """
+    Compiles the fields of a schema into a validation function.
+
+    The function raises ``ValidationError`` listing every wrong or unknown field of the content.
+    ``None`` values are accepted for every field, unknown field types are not checked.
+
+    :param fields: list of ``_Field`` or dict with ``name`` and ``type``
+    :return: a function that takes a content (dict)
+    """
+    checks = dict()
+    for field in fields:
+        name, field_type = _field_pair(field)
+        checks[name] = (_CHECKS.get(field_type, _is_any), field_type)
+
+    def validate(content):
+        errors = None
+        for key, value in content.iteritems():
+            try:
+                check, field_type = checks[key]
+            except KeyError:
+                if errors is None:
+                    errors = []
+                errors.append("%s: field not in the schema" % key)
+                continue
+            if value is not None and not check(value):
+                if errors is None:
+                    errors = []
+                errors.append("%s: expected %s, got %r" % (key, field_type, value))
+        if errors:
+            raise ValidationError(errors)
+
+    return validate
+
+
+class SchemaCache(object):
+    """
+    Caches the fields of schemas and user schemas, and the validators compiled from them.
+
+    It is keyed by schema id, the ``loader`` passed to the getters is called only on a miss.
+    """
+
+    def __init__(self):
+        self._fields = dict()
+        self._validators = dict()
+
+    def fields(self, schema_id, loader):
+        """
+        :param schema_id: (id) of the schema or user schema
+        :param loader: function returning the list of fields of the schema
+        :return: dict name -> field
+        """
+        try:
+            return self._fields[schema_id]
+        except KeyError:
+            fields = dict()
+            for field in loader():
+                fields[_field_pair(field)[0]] = field
+            self._fields[schema_id] = fields
+            return fields
+
+    def validator(self, schema_id, loader):
+        try:
+            return self._validators[schema_id]
+        except KeyError:
+            validate = compile_validator(self.fields(schema_id, loader).values())
+            self._validators[schema_id] = validate
+            return validate
+
+    def validate(self, schema_id, content, loader):
+        if content:
+            self.validator(schema_id, loader)(content)
+
+    def invalidate(self, schema_id=None):
+        """
+        Drops the cached structure of ``schema_id``, or of all schemas if not specified.
+        """
+        if schema_id is None:
+            self._fields.clear()
+            self._validators.clear()
+        else:
+            self._fields.pop(schema_id, None)
+            self._validators.pop(schema_id, None)
@@ -1,9 +1,12 @@
 import time
 
 import cfg
-from chino.api import ChinoAPIClient
-from chino.exceptions import CallError
-from chino.objects import _DictContent, _Field
+from chino.api import ChinoAPIClient, ChinoAPIPermissions
+from chino.cache import BlobCache, UsernameIndex
+from chino.exceptions import CallError, ClientError, ValidationError
+from chino.objects import _DictContent, _Field, Document, Search
+from chino.local import LocalDocuments
+from chino.query import _frozen, check_query
 
 __author__ = 'Stefano Tranquillini <stefano@chino.io>'
 
@@ -11,6 +14,11 @@ import unittest
 import logging
 import logging.config
 import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
 from os import path
 
 logging.config.fileConfig(path.join([path.dirname(__file__), 'logging.conf']))
@@ -475,8 +483,22 @@ class PermissionChinoTest2(BaseChinoTest):
         self.assertTrue(permissions[0].permission.manage == ['R'])
         self.assertTrue(permissions[1].permission.manage == ['R', 'U', 'L'])
         self.assertTrue(permissions[1].permission.authorize == ['A'])
+        self.assertTrue(self.chino.permissions.can('R', 'documents', document._id, parent_id=schema,
+                                                   subject_type='users', subject_id=user._id))
+        self.assertTrue(self.chino.permissions.can('read', 'Document', parent_id=schema, subject_type='users',
+                                                   subject_id=user._id))
+        self.assertFalse(self.chino.permissions.can('D', 'documents', document._id, parent_id=schema,
+                                                    subject_type='users', subject_id=user._id))
         self.chino.users.logout()
         self.chino.auth.set_auth_admin()
+        desired = {('users', user._id): [dict(resource_type='repositories', manage=['R']),
+                                         dict(resource_type='schemas', resource_id=schema,
+                                              resource_child_type='documents', manage=['R', 'U', 'L', 'D'],
+                                              authorize=['A'])]}
+        changes = self.chino.permissions.reconcile(desired)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0].manage, ['D'])
+        self.assertEqual(self.chino.permissions.reconcile(desired), [])
         self.chino.documents.delete(document._id, force=True)
         self.chino.schemas.delete(schema, force=True)
         self.chino.repositories.delete(repo, force=True)
@@ -513,6 +535,10 @@ class DocumentChinoTest(BaseChinoTest):
         self.assertIsNone(list.documents[0].content)
         list = self.chino.documents.list(self.schema, True)
         self.assertIsNotNone(list.documents[0].content)
+        raw = self.chino.documents.list(self.schema, True, as_dict=True)
+        self.assertEqual(raw.paging.total_count, list.paging.total_count)
+        self.assertEqual(raw.documents[0]['content'], list.documents[0].content.to_dict())
+        self.assertEqual(self.chino.documents.detail(document._id, as_dict=True)['document_id'], document._id)
         self.chino.documents.delete(document._id, True)
 
     @unittest.skip("not working, timeout`")
@@ -598,6 +624,33 @@ class DocumentChinoTest(BaseChinoTest):
             "\n %s \n %s \n" % (detail.to_json(), detail2.to_json()))
         self.chino.schemas.delete(detail._id, force=True)
 
+    def test_diff_update(self):
+        content = dict(fieldInt=123, fieldString='test', fieldBool=False, fieldDate='2015-02-19',
+                       fieldDateTime='2015-02-19T16:39:47')
+        document = self.chino.documents.create(self.schema, content=content)
+        document = self.chino.documents.detail(document._id)
+        # nothing changed, no call
+        self.assertIs(document, self.chino.documents.diff_update(document, dict(content)))
+        content['fieldInt'] = 349
+        self.chino.documents.diff_update(document, content)
+        document = self.chino.documents.detail(document._id)
+        self.assertEqual(349, document.content.fieldInt)
+        self.assertEqual('test', document.content.fieldString)
+        self.chino.documents.delete(document._id, True)
+
+    def test_validation(self):
+        chino = ChinoAPIClient(customer_id=cfg.customer_id, customer_key=cfg.customer_key, url=cfg.url,
+                               validate=True)
+        with self.assertRaises(ValidationError):
+            chino.documents.create(self.schema, content=dict(fieldInt='123'))
+        with self.assertRaises(ValidationError):
+            chino.documents.create(self.schema, content=dict(fieldDate='19-02-2015'))
+        with self.assertRaises(ValidationError):
+            chino.documents.create(self.schema, content=dict(notAField=1))
+        document = chino.documents.create(self.schema, content=dict(fieldInt=123, fieldBool=True,
+                                                                    fieldDateTime='2015-02-19T16:39:47'))
+        chino.documents.delete(document._id, True)
+
 
 class BlobChinoTest(BaseChinoTest):
     def setUp(self):
@@ -640,6 +693,155 @@ class BlobChinoTest(BaseChinoTest):
         self.assertEqual(md5_detail.hexdigest(), blob.md5)
         self.blob = blob
 
+    def test_blob_parallel(self):
+        self.document = self.chino.documents.create(self.schema, content=dict(name='test'))
+        blob = self.chino.blobs.send(self.document._id, 'blobTest', 'logo.png', chunk_size=1024, parallelism=4)
+        self.blob = blob
+        blob_detail = self.chino.blobs.detail(blob.blob_id)
+        self.assertEqual(hashlib.sha1(blob_detail.content).hexdigest(), blob.sha1)
+        with open('logo.png', 'rb') as rd:
+            self.assertEqual(hashlib.sha1(rd.read()).hexdigest(), blob.sha1)
+
+    def _interrupted_send(self, file_path, journal, stop_at=None):
+        """
+        Sends ``file_path`` with the journal, the upload stops before the chunk at ``stop_at``.
+        :return: the offsets of the chunks sent and the blob, None if interrupted
+        """
+        sent = []
+        chunk = self.chino.blobs.chunk
+
+        def send_chunk(upload_id, data, length, offset):
+            if offset == stop_at:
+                raise KeyboardInterrupt()
+            sent.append(offset)
+            return chunk(upload_id, data, length, offset)
+
+        self.chino.blobs.chunk = send_chunk
+        try:
+            return sent, self.chino.blobs.send(self.document._id, 'blobTest', file_path, chunk_size=1024,
+                                               journal=journal)
+        except KeyboardInterrupt:
+            return sent, None
+        finally:
+            del self.chino.blobs.chunk
+
+    def test_blob_resume(self):
+        self.document = self.chino.documents.create(self.schema, content=dict(name='test'))
+        journal = 'logo.png.journal'
+        offsets = range(0, path.getsize('logo.png'), 1024)
+        sent, blob = self._interrupted_send('logo.png', journal, stop_at=5 * 1024)
+        self.assertEqual(sent, offsets[:5])
+        self.assertIsNone(blob)
+        # a line cut by the interruption is ignored
+        with open(journal, 'ab') as wr:
+            wr.write('5120 10')
+        sent, blob = self._interrupted_send('logo.png', journal)
+        self.assertEqual(sent, offsets[5:])
+        self.assertFalse(path.exists(journal))
+        with open('logo.png', 'rb') as rd:
+            self.assertEqual(hashlib.sha1(rd.read()).hexdigest(), blob.sha1)
+        self.blob = blob
+
+    def test_blob_resume_restart(self):
+        self.document = self.chino.documents.create(self.schema, content=dict(name='test'))
+        journal = 'resume.png.journal'
+        shutil.copy('logo.png', 'resume.png')
+        offsets = range(0, path.getsize('resume.png'), 1024)
+        try:
+            self._interrupted_send('resume.png', journal, stop_at=5 * 1024)
+            # the file changed: a new upload, all the chunks are sent
+            os.utime('resume.png', (time.time() + 10, time.time() + 10))
+            self._interrupted_send('resume.png', journal, stop_at=3 * 1024)
+            with open(journal, 'rb') as rd:
+                lines = rd.read().split('\n')
+            self.assertEqual(lines[1:], ['0 1024', '1024 1024', '2048 1024', ''])
+            # the upload is not on the server anymore: it starts again from scratch
+            header = json.loads(lines[0])
+            header['upload_id'] = '00000000-0000-0000-0000-000000000000'
+            with open(journal, 'wb') as wr:
+                wr.write('\n'.join([json.dumps(header)] + lines[1:]))
+            sent, blob = self._interrupted_send('resume.png', journal)
+            self.assertEqual(sent, [3 * 1024] + offsets)
+            self.blob = blob
+        finally:
+            os.remove('resume.png')
+            if path.exists(journal):
+                os.remove(journal)
+
+    def test_blob_stream(self):
+        self.document = self.chino.documents.create(self.schema, content=dict(name='test'))
+        with open('logo.png', 'rb') as rd:
+            content = rd.read()
+        with open('logo.png', 'rb') as rd:
+            blob = self.chino.blobs.send_stream(self.document._id, 'blobTest', 'logo.png', rd, chunk_size=1000)
+        self.blob = blob
+        self.assertEqual(hashlib.sha1(content).hexdigest(), blob.sha1)
+        parts = (content[i:i + 100] for i in range(0, len(content), 100))
+        blob = self.chino.blobs.send_stream(self.document._id, 'blobTest', 'logo.png', parts, chunk_size=1000)
+        self.blob = blob
+        self.assertEqual(self.chino.blobs.detail(blob.blob_id).content, content)
+
+    def test_blob_index(self):
+        chino = ChinoAPIClient(customer_id=cfg.customer_id, customer_key=cfg.customer_key, url=cfg.url,
+                               blob_index=':memory:')
+        self.document = chino.documents.create(self.schema, content=dict(name='test'))
+        blob = chino.blobs.send(self.document._id, 'blobTest', 'logo.png')
+        self.blob = blob
+        self.assertEqual(blob, chino.blobs.send(self.document._id, 'blobTest', 'logo.png'))
+        self.assertEqual(chino.blob_index.stats['hits'], 1)
+        self.assertEqual(chino.blob_index.stats['bytes_avoided'], blob.bytes)
+
+    def test_blob_download(self):
+        self.document = self.chino.documents.create(self.schema, content=dict(name='test'))
+        blob = self.chino.blobs.send(self.document._id, 'blobTest', 'logo.png')
+        self.blob = blob
+        received = []
+        download = self.chino.blobs.download(blob.blob_id, 'out_download.png', chunk_size=1024, sha1=blob.sha1,
+                                             md5=blob.md5, progress=lambda done, total: received.append(done))
+        self.assertEqual(download.bytes, blob.bytes)
+        self.assertEqual(received[-1], blob.bytes)
+        with open('out_download.png', 'rb') as rd:
+            self.assertEqual(hashlib.md5(rd.read()).hexdigest(), blob.md5)
+        content = ''.join(self.chino.blobs.iter_content(blob.blob_id, chunk_size=1024))
+        self.assertEqual(hashlib.sha1(content).hexdigest(), blob.sha1)
+        with self.assertRaises(CallError):
+            self.chino.blobs.download(blob.blob_id, 'out_download.png', sha1='wrong')
+        download = self.chino.blobs.download(blob.blob_id, 'out_download.png', chunk_size=1024, parallelism=4,
+                                             sha1=blob.sha1)
+        self.assertEqual(download.md5, blob.md5)
+
+    def test_blob_many(self):
+        self.document = self.chino.documents.create(self.schema, content=dict(name='test'))
+        other = self.chino.documents.create(self.schema, content=dict(name='test'))
+        received = []
+        results = self.chino.blobs.send_many([(self.document._id, 'blobTest', 'logo.png'),
+                                              (other._id, 'blobTest', 'logo.png'),
+                                              (other._id, 'blobTest', 'missing.png')],
+                                             parallelism=2, chunk_size=1024, max_bytes_per_second=1024 * 1024,
+                                             progress=lambda *args: received.append(args))
+        self.blob = results[0]
+        self.assertEqual(results[0].sha1, results[1].sha1)
+        self.assertIsInstance(results[2], ClientError)
+        self.assertEqual(received[-1][3], results[0].bytes * 2)
+        self.chino.blobs.delete(results[1].blob_id)
+        self.chino.documents.delete(other._id, True)
+
+    def test_blob_cache(self):
+        chino = ChinoAPIClient(customer_id=cfg.customer_id, customer_key=cfg.customer_key, url=cfg.url,
+                               blob_cache='blob_cache_test')
+        self.document = chino.documents.create(self.schema, content=dict(name='test'))
+        blob = chino.blobs.send(self.document._id, 'blobTest', 'logo.png')
+        self.blob = blob
+        first = chino.blobs.detail(blob.blob_id)
+        self.assertEqual(first, chino.blobs.detail(blob.blob_id))
+        self.assertEqual(chino.blob_cache.stats['hits'], 1)
+        opened = chino.blobs.open(blob.blob_id)
+        with opened.content as rd:
+            self.assertEqual(hashlib.sha1(rd.read()).hexdigest(), blob.sha1)
+        chino.blobs.delete(blob.blob_id)
+        del self.blob
+        self.assertIsNone(chino.blob_cache.path(blob.blob_id))
+
 
 # @unittest.skip("not working on prod`")
 class SearchDocsChinoTest(BaseChinoTest):
@@ -702,6 +904,214 @@ class SearchDocsChinoTest(BaseChinoTest):
         res = self.chino.searches.search(self.schema, filters=[{"field": "fieldInt", "type": "eq", "value": 123}])
         self.assertEqual(res.paging.total_count, 9, res)
 
+    def test_query(self):
+        for i in range(5):
+            self.chino.documents.create(self.schema, content=dict(fieldInt=i, fieldString='test', fieldBool=False,
+                                                                  fieldDate='2015-02-19',
+                                                                  fieldDateTime='2015-02-19T16:39:47'))
+        time.sleep(5)  # wait the index max update time
+        query = self.chino.searches.query(self.schema).filter('fieldInt', 'gte', 1).sort('fieldInt', 'desc')
+        res = query.run(limit=2)
+        self.assertEqual(res.paging.total_count, 4, res)
+        self.assertEqual([doc.content.fieldInt for doc in res.documents], [4, 3])
+        res = query.run(offset=2, limit=2)
+        self.assertEqual([doc.content.fieldInt for doc in res.documents], [2, 1])
+        self.assertIs(query.compile(), query.compile())
+        with self.assertRaises(ValidationError):
+            self.chino.searches.query(self.schema).filter('fieldInt', 'eq', 'wrong').run()
+        with self.assertRaises(ValidationError):
+            self.chino.searches.query(self.schema).filter('missing', 'eq', 1).run()
+        ids = [doc._id for doc in self.chino.searches.iter_documents(self.schema, page_size=2, prefetch=True,
+                                                                     sort=[dict(field='fieldInt', order='asc')])]
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+        chino = ChinoAPIClient(customer_id=cfg.customer_id, customer_key=cfg.customer_key, url=cfg.url,
+                               document_cache=True)
+        hydrated = [doc._id for doc in chino.searches.iter_hydrated(self.schema, page_size=2,
+                                                                    sort=[dict(field='fieldInt', order='asc')])]
+        self.assertEqual(hydrated, ids)
+        again = [doc._id for doc in chino.searches.iter_hydrated(self.schema, page_size=2,
+                                                                 sort=[dict(field='fieldInt', order='asc')])]
+        self.assertEqual(again, ids)
+        self.assertEqual(chino.document_cache.stats['hits'], 5)
+
+    def test_scan(self):
+        for i in range(6):
+            self.chino.documents.create(self.schema, content=dict(fieldInt=i, fieldString='test', fieldBool=False,
+                                                                  fieldDate='2015-02-19',
+                                                                  fieldDateTime='2015-02-19T16:39:47'))
+        time.sleep(5)  # wait the index max update time
+        found = [doc.content.fieldInt for doc in self.chino.searches.scan(self.schema, 'fieldInt', partitions=3,
+                                                                          page_size=2)]
+        self.assertEqual(sorted(found), range(6))
+        found = [doc.content.fieldInt for doc in self.chino.searches.scan(self.schema, 'fieldInt', bounds=[2, 4],
+                                                                          ordered=True, page_size=2)]
+        self.assertEqual(found, range(6))
+
+    def test_documents_multi(self):
+        fields = [dict(name='fieldInt', type='integer', indexed=True)]
+        other = self.chino.schemas.create(self.repo, 'test', fields)._id
+        for i in range(4):
+            self.chino.documents.create(self.schema, content=dict(fieldInt=i * 2, fieldString='test', fieldBool=False,
+                                                                  fieldDate='2015-02-19',
+                                                                  fieldDateTime='2015-02-19T16:39:47'))
+            self.chino.documents.create(other, content=dict(fieldInt=i * 2 + 1))
+        time.sleep(5)  # wait the index max update time
+        found = self.chino.searches.documents_multi([self.schema, other], sort=[dict(field='fieldInt', order='desc')],
+                                                    limit=5, page_size=2)
+        self.assertEqual([doc.content.fieldInt for doc in found], [7, 6, 5, 4, 3])
+        self.chino.schemas.delete(other, True)
+
+    def test_count_cache(self):
+        chino = ChinoAPIClient(customer_id=cfg.customer_id, customer_key=cfg.customer_key, url=cfg.url,
+                               count_cache=True)
+        filters = [{"field": "fieldInt", "type": "eq", "value": 123}]
+        self.assertEqual(chino.searches.documents(self.schema, "COUNT", filters=filters), 0)
+        chino.searches.documents(self.schema, "COUNT", filters=filters)
+        self.assertEqual(chino.count_cache.stats['hits'], 1)
+        chino.documents.create(self.schema, content=dict(fieldInt=123, fieldString='test', fieldBool=False,
+                                                         fieldDate='2015-02-19', fieldDateTime='2015-02-19T16:39:47'))
+        time.sleep(5)  # wait the index max update time
+        self.assertEqual(chino.searches.documents(self.schema, "COUNT", filters=filters), 1)
+        self.assertEqual(chino.searches.documents(self.schema, "COUNT", filters=filters, fresh=True), 1)
+
+
+class LocalDocumentsTest(unittest.TestCase):
+    def test_search(self):
+        documents = [dict(document_id=str(i), schema_id='schema', content=dict(fieldInt=i, fieldString=name))
+                     for i, name in enumerate(['Test', 'test', 'other', None])]
+        for local in (LocalDocuments(documents), LocalDocuments(documents, indexes=['fieldInt', 'fieldString'])):
+            res = local.search(filters=[dict(field='fieldString', type='eq', value='TEST')])
+            self.assertEqual([doc._id for doc in res.documents], ['0', '1'])
+            res = local.search(filters=[dict(field='fieldString', type='eq', value='test', case_sensitive=True)])
+            self.assertEqual([doc._id for doc in res.documents], ['1'])
+            res = local.search(filters=[dict(field='fieldInt', type='gte', value=1),
+                                        dict(field='fieldString', type='neq', value='other')],
+                               sort=[dict(field='fieldInt', order='desc')])
+            self.assertEqual([doc._id for doc in res.documents], ['3', '1'])
+            res = local.search(filter_type='or', filters=[dict(field='fieldInt', type='lt', value=1),
+                                                          dict(field='fieldString', type='is', value=None)])
+            self.assertEqual(res.paging.total_count, 2)
+            self.assertEqual(local.search('COUNT', filters=[dict(field='fieldInt', type='in', value=[1, 2])]), 2)
+
+    def test_copies(self):
+        documents = [dict(document_id=str(i), content=dict(age=10, tags=['a'])) for i in range(2)]
+        local = LocalDocuments(documents, indexes=['age'])
+        documents[0]['content']['age'] = 20
+        res = local.search(filters=[dict(field='age', type='eq', value=10)])
+        res.documents[0].content.age = 50
+        local.find()[1]['content']['tags'].append('b')
+        self.assertEqual(local.search('COUNT', filters=[dict(field='age', type='eq', value=10)]), 2)
+        self.assertEqual(local.search('COUNT', filters=[dict(field='age', type='eq', value=50)]), 0)
+        self.assertEqual(local.find()[1]['content']['tags'], ['a'])
+
+    def test_booleans(self):
+        documents = [dict(document_id='0', content=dict(flag=True)), dict(document_id='1', content=dict(flag=1)),
+                     dict(document_id='2', content=dict(flag=0))]
+        for local in (LocalDocuments(documents), LocalDocuments(documents, indexes=['flag'])):
+            res = local.find([dict(field='flag', type='eq', value=True)])
+            self.assertEqual([doc['document_id'] for doc in res], ['0'])
+            res = local.find([dict(field='flag', type='in', value=[1, False])])
+            self.assertEqual([doc['document_id'] for doc in res], ['1'])
+            res = local.find([dict(field='flag', type='gte', value=0)])
+            self.assertEqual([doc['document_id'] for doc in res], ['1', '2'])
+            res = local.find([dict(field='flag', type='neq', value=1)])
+            self.assertEqual([doc['document_id'] for doc in res], ['0', '2'])
+
+
+class PlanTest(unittest.TestCase):
+    def test_body(self):
+        chino = ChinoAPIClient(customer_id='customer', customer_key='key')
+        filters = [dict(field='fieldInt', type='gt', value=1), dict(field='fieldString', type='eq', value='a',
+                                                                    case_sensitive=True, custom=[1])]
+        plan = chino.searches.plan('documents', 'schema', filters=filters, sort=[dict(field='fieldInt')])
+        body = json.loads(plan.body)
+        # the filters are sent as given
+        self.assertEqual(body['filter'], filters)
+        self.assertEqual(body['sort'], [dict(field='fieldInt')])
+        self.assertIs(plan, chino.searches.plan('documents', 'schema', filters=[dict(f) for f in filters],
+                                                sort=[dict(field='fieldInt')]))
+
+    def test_check(self):
+        fields = dict(fieldInt=dict(name='fieldInt', type='integer', indexed=True))
+        sort = [_frozen(dict(field='insert_date', order='desc'))]
+        filters = [_frozen(dict(field='last_update', type='gte', value='2015-02-24T22:27:35.919')),
+                   _frozen(dict(field='fieldInt', type='eq', value=1))]
+        check_query('documents', filters, sort, fields)
+        with self.assertRaises(ValidationError):
+            check_query('documents', [_frozen(dict(field='missing', type='eq', value=1))], [], fields)
+        with self.assertRaises(ValidationError):
+            check_query('documents', [_frozen(dict(field='insert_date', type='gt', value=1))], [], fields)
+
+
+class BlobCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, directory, *names):
+        for name in names:
+            with open(path.join(directory, name), 'w') as wr:
+                wr.write('{}')
+
+    def test_foreign_files(self):
+        # a directory that is not a cache is not used
+        self._write(self.directory, 'report.pdf', 'config', 'config.json')
+        with self.assertRaises(ClientError):
+            BlobCache(self.directory)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['config', 'config.json', 'report.pdf'])
+        # in a cache only the files left by the cache are removed
+        directory = path.join(self.directory, 'cache')
+        BlobCache(directory)
+        self._write(directory, 'report.pdf', 'tmpa1_b2.tmp', 'blob.json.tmp', 'blob')
+        cache = BlobCache(directory)
+        self.assertEqual(sorted(os.listdir(directory)), ['.chino_blob_cache', 'report.pdf'])
+        self.assertEqual(cache.size, 0)
+
+
+class UsernameIndexTest(unittest.TestCase):
+    def test_unicode(self):
+        index = UsernameIndex()
+        self.assertTrue(index.may_exist('schema', '\xc3\x80B', lambda: (1, [u'\xc0B'])))
+        self.assertTrue(index.may_exist('schema', u'\xe0b', None))
+        index.add('\xc3\x89', 'schema')
+        self.assertTrue(index.may_exist('schema', u'\xe9', None))
+        self.assertEqual(index.stats['local'], 0)
+
+
+class PermissionIndexTest(unittest.TestCase):
+    def test_without_client(self):
+        perms = ChinoAPIPermissions(None, 'http://localhost/', 1, session=False)
+        perms.apicall = lambda method, url, **kw: dict(permissions=[
+            dict(access='Structure', resource_type='Repository', permission=dict(Manage=['L']))])
+        self.assertTrue(perms.can('L', 'repositories'))
+        self.assertFalse(perms.can('C', 'repositories'))
+        self.assertIsNotNone(perms.permission_index)
+        self.assertIsNone(ChinoAPIPermissions.permission_index)
+
+
+class ObjectsTest(unittest.TestCase):
+    def test_content(self):
+        content = dict(fieldInt=1)
+        document = Document(document_id='id', schema_id='schema', content=content)
+        document.content.fieldInt = 2
+        self.assertEqual(content, dict(fieldInt=1))
+        self.assertEqual(document.to_dict()['content'], dict(fieldInt=2))
+
+    def test_pickle(self):
+        document = Document(document_id='id', schema_id='schema', content=dict(fieldInt=1, fieldString='test'))
+        search = Search('schema', 'FULL_CONTENT', sort=[dict(field='fieldInt', order='asc')],
+                        filters=[dict(field='fieldInt', type='eq', value=1)])
+        for protocol in (0, 2):
+            copy = pickle.loads(pickle.dumps(document, protocol))
+            self.assertEqual(copy.to_dict(), document.to_dict())
+            self.assertEqual(copy.content.fieldString, 'test')
+            copy = pickle.loads(pickle.dumps(search, protocol))
+            self.assertEqual(copy.to_dict(), search.to_dict())
+            self.assertEqual(copy.filters[0].value, 1)
+
 
 class SearchUsersChinoTest(BaseChinoTest):
     def setUp(self):
@@ -742,6 +1152,22 @@ class SearchUsersChinoTest(BaseChinoTest):
         res = self.chino.searches.users(self.schema, filters=[{"field": "fieldInt", "type": "eq", "value": 123}])
         self.assertEqual(res.paging.total_count, 9, res)
 
+    def test_username_index(self):
+        chino = ChinoAPIClient(customer_id=cfg.customer_id, customer_key=cfg.customer_key, url=cfg.url,
+                               username_index=True)
+        chino.users.create(self.schema, username="user_test_taken", password='1234567890AAaa',
+                           attributes=dict(fieldInt=123, fieldString='test', fieldBool=False,
+                                           fieldDate='2015-02-19', fieldDateTime='2015-02-19T16:39:47'))
+        time.sleep(5)  # wait the index max update time
+
+        def exists(username):
+            return chino.searches.users(self.schema, "USERNAME_EXISTS",
+                                        filters=[{"field": "username", "type": "eq", "value": username}])
+
+        self.assertTrue(exists('user_test_taken'))
+        self.assertFalse(exists('user_test_free'))
+        self.assertEqual(chino.username_index.stats['local'], 1)
+
 
 class PermissionChinoTest(BaseChinoTest):
     def setUp(self):